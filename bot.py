@@ -7,8 +7,19 @@ from config import LOG_ID, PREFIX, OWNERS, GUILD_ID
 
 load_dotenv()
 
+from utils.db_utils import close_db, ensure_indexes, warm_up  # Must come after load_dotenv, it reads MONGO_URI on import
+from utils.log_queue import LogQueue
+from utils.events import dispatch_member_update
+
 
 class Bot(commands.Bot):
+    db_warm_up = None  # Seconds it took to connect to the db at startup
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.log_queue = LogQueue(self, LOG_ID)  # Everything headed for the log channel goes through this
+        self.purging = set()  # Message IDs /purge is deleting, it logs them itself so the delete logs skip them
+
     async def on_ready(self):
         # Print startup message
         startup = bot.user.name + " is running"
@@ -17,7 +28,21 @@ class Bot(commands.Bot):
         await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name=f"for errors..."))
 
         channel = self.get_channel(LOG_ID)
-        await channel.send(f"<@114352655857483782> - restart detected.")
+        await channel.send(f"<@114352655857483782> - restart detected.\n"
+                           f"Database warm up took {self.db_warm_up * 1000:.0f}ms")
+
+    async def start(self, *args, **kwargs):
+        # Connect to the db before logging in, so listeners don't pay for it when the first events come in
+        self.db_warm_up = await warm_up()
+        print(f"Database ready in {self.db_warm_up * 1000:.0f}ms")
+
+        await ensure_indexes()  # Cogs have declared their indexes by now
+        await super().start(*args, **kwargs)
+
+    async def close(self):
+        await self.log_queue.close()
+        await close_db()  # Make sure buffered db writes aren't lost
+        await super().close()
 
 
 intents = discord.Intents.all()
@@ -25,6 +50,7 @@ bot = Bot(command_prefix=commands.when_mentioned_or(PREFIX), messages=True, case
           allowed_mentions=discord.AllowedMentions(roles=False, everyone=False), intents=intents, debug_guilds=[GUILD_ID])
 
 bot.remove_command("help")
+bot.add_listener(dispatch_member_update, "on_member_update")  # Cogs subscribe through utils.events instead
 
 # Load cogs
 for filename in os.listdir('./cogs'):
@@ -1,10 +1,17 @@
 import discord
 from discord.ext import commands
 from config import LOG_ID, RED, GUILD_ID
-from utils.utils import utc_now
+from utils.utils import utc_now, _crop, traceback
+from utils.pluralkit import PKClient
+from utils.transcript import TranscriptWriter
+from utils.message_store import MessageStore, StoredMessage, format_stored
+from utils.events import MemberUpdate, subscribe_member_update, unsubscribe_member_update
 import traceback as tb
 from math import ceil
-import aiohttp
+from io import BytesIO
+import asyncio
+import time
+import os
 
 MODERATION = 0x481D24  # dark red
 DELETE = 0xff595e  # red
@@ -15,18 +22,14 @@ VOICE = 0x99e5da  # aqua ish
 LEAVE = 0x1982c4  # blue
 NICKNAME = 0x6a4c93  # purple
 
-PK_MESSAGE_ENDPOINT = "https://api.pluralkit.me/v2/messages"
+# Seconds deletions are held for so their PK checks can be done together
+# This also gives PK time to register the messages it deletes itself when proxying
+DELETE_WINDOW = 2
+INVITE_WINDOW = 1  # Seconds joins are grouped for, so a raid shares one invites() fetch rather than one each
+ERROR_WINDOW = 10 * 60  # Seconds an error is only counted for after being reported, rather than reported again
+ERROR_SUMMARY_INTERVAL = 60  # Seconds between "happened N more times" summaries
 
-
-def _crop(text: str, chars=2000, border="--Snippet--"):
-    """
-    Crop text to a certain character length based on word borders
-    """
-    if len(text) > chars:
-        text = text[:chars - len(border)]  # initial crop, just get the character count right
-        text = " ".join(text.split(" ")[:-1])  # cut off at nearest word boundary
-        text += border  # append border to signify cut off
-    return text
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
 async def error_embed(ctx: commands.Context, error: str):
@@ -35,95 +38,240 @@ async def error_embed(ctx: commands.Context, error: str):
     return await ctx.send(embed=em)
 
 
-def traceback(e: Exception):  # Converts an exception into the full traceback report
-    return ''.join(tb.format_exception(None, e, e.__traceback__))
+def fingerprint(e: Exception) -> str:
+    """Identify an error by its type and the deepest line of our code it went through, e.g. KeyError at cogs/x.py:5"""
+    frames = tb.extract_tb(e.__traceback__)
+    ours = [frame for frame in frames if frame.filename.startswith(ROOT) and "site-packages" not in frame.filename]
+    if not frames:
+        return type(e).__name__
+
+    frame = (ours or frames)[-1]
+    return f"{type(e).__name__} at {os.path.relpath(frame.filename, ROOT)}:{frame.lineno} in {frame.name}"
+
+
+class ErrorReporter:
+    """
+    Posts errors to the log channel without letting an error storm bury everything else
+    The first time an error is seen it's posted with the full traceback attached. Repeats for the next ERROR_WINDOW
+    seconds are only counted, with a summary of the counts posted every ERROR_SUMMARY_INTERVAL seconds
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.seen = {}  # fingerprint -> [first reported at, repeats since the last summary, repeats in total]
+        self.task = None
+
+    def report(self, error: Exception, where: str):
+        key = fingerprint(error)
+        entry = self.seen.get(key)
+        if entry and time.monotonic() - entry[0] < ERROR_WINDOW:
+            entry[1] += 1
+            entry[2] += 1
+            if self.task is None or self.task.done():
+                self.task = self.bot.loop.create_task(self.run())
+            return
+
+        self.seen[key] = [time.monotonic(), 0, 0]
+        error_text = traceback(error)
+        print(f"Error in {where}\n{error_text}")
+
+        file = discord.File(BytesIO(error_text.encode()), filename="traceback.txt")
+        content = f"⚠️ Error in {where}\n`{key}`\n```{_crop(str(error) or type(error).__name__, chars=1500)}```"
+        self.bot.log_queue.put(content=content, file=file)
+
+    async def run(self):
+        while self.seen:
+            await asyncio.sleep(ERROR_SUMMARY_INTERVAL)
+            self.summarise()
 
+    def summarise(self):
+        now = time.monotonic()
+        for key, entry in list(self.seen.items()):
+            first, repeats, total = entry
+            if repeats:
+                self.bot.log_queue.put(content=f"🔁 `{key}` happened {repeats} more time{'s' if repeats != 1 else ''}"
+                                               f" ({total + 1} times since it was reported)")
+                entry[1] = 0
+            if now - first >= ERROR_WINDOW:
+                del self.seen[key]  # The next one gets reported in full again
 
-async def is_pk_msg(message_id: int) -> bool:
-    # !! This doesnt account for rate limiting so... bad. But lets see how it goes
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"{PK_MESSAGE_ENDPOINT}/{message_id}") as response:
-            if response.status == 429:
-                print("PK rate limited us!")
-            # 404 (not ok) means the message isnt a pk message
-            # 429 (not ok) is rate limited which means we dont know anyway
-            # 200 (ok) means it is a pk message
-            # This means that ok=pk !ok=!pk
-            return response.ok
+    def close(self):
+        if self.task:
+            self.task.cancel()
 
 
 class Log(commands.Cog):
     def __init__(self, bot):
         self.bot = bot  # type: commands.Bot
-        self.invite_cache = {}
+        self.invite_cache = {}  # code -> (uses, inviter, max uses)
+        # code -> (deleted at, cache entry) for invites deleted since the last fetch, one time invites are deleted as
+        # they're used
+        self.deleted_invites = {}
+        self.last_invite_fetch = 0  # time.monotonic() the last diff_invites fetch started at
+        self.invite_check = None  # Task working out the invites used by the current group of joins
+        self.pk = PKClient()
+        self.messages = MessageStore()  # Content of recent messages, for logging deletes and edits
+        self.errors = ErrorReporter(bot)
+
+        self.pending_deletes = []  # Deleted messages waiting for the window to close
+        self.delete_window_open = False
+        self.delete_batch = None  # Task logging the most recent batch
+
+        subscribe_member_update("Log", self.member_updated)
+
+    def cog_unload(self):
+        unsubscribe_member_update("Log")
+        self.bot.loop.create_task(self.pk.close())
+        self.errors.close()
+
+    def set_author(self, em: discord.Embed, message: StoredMessage):
+        """Show the message's author on the embed, as they are now if we can still see them"""
+        guild = self.bot.get_guild(GUILD_ID)
+        user = (guild and guild.get_member(message.author_id)) or self.bot.get_user(message.author_id)
+        if user:
+            em.set_author(name=user.display_name, icon_url=user.display_avatar.url)
+        else:
+            em.set_author(name=message.author_name)
+        em.set_footer(text=f"User ID: {message.author_id}")
 
     @commands.Cog.listener()
-    async def on_message_delete(self, message: discord.Message):
+    async def on_message(self, message: discord.Message):
         if not message.guild or message.guild.id != GUILD_ID:
             return
         if message.author.bot:  # ignore bots
             return
         if message.channel.id == LOG_ID:
             return
-        if await is_pk_msg(message.id):
+
+        self.messages.add(StoredMessage.from_message(message))
+
+    def stored_message(self, message_id: int, cached: discord.Message = None):
+        """Get a message from the store, or discord's cache if the store doesn't have it (e.g. just after a restart)"""
+        message = self.messages.get(message_id)
+        if not message and cached and not cached.author.bot:
+            message = StoredMessage.from_message(cached)
+        return message
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        if payload.guild_id != GUILD_ID or payload.channel_id == LOG_ID:
+            return
+
+        message = self.stored_message(payload.message_id, payload.cached_message)
+        self.messages.pop(payload.message_id)
+        if payload.message_id in self.bot.purging:  # /purge logs its own transcript
+            self.bot.purging.discard(payload.message_id)
+            return
+        if not message:  # Too old, sent by a bot or sent while we were offline
+            return
+
+        self.pending_deletes.append(message)
+        if not self.delete_window_open:
+            self.delete_window_open = True
+            self.delete_batch = self.bot.loop.create_task(self.log_deletes(self.delete_batch))
+
+    async def log_deletes(self, previous: asyncio.Task = None):
+        """
+        Log everything deleted during the window, skipping PK messages
+        previous is the last batch's task, batches are logged in order even if one's PK checks are quicker
+        """
+        await asyncio.sleep(DELETE_WINDOW)
+        messages, self.pending_deletes = self.pending_deletes, []
+        self.delete_window_open = False  # Anything deleted from now on goes in the next batch
+
+        is_pk = await self.pk.check_many(message.id for message in messages)
+        if previous:
+            await asyncio.wait([previous])
+
+        for message in messages:
+            if is_pk[message.id]:
+                continue
+
+            desc = f"🗑️ **Message from <@{message.author_id}> deleted in <#{message.channel_id}>**\n" \
+                   f"{_crop(message.content)}"
+            em = discord.Embed(description=desc, colour=DELETE)
+            self.set_author(em, message)
+            if is_pk[message.id] is None:
+                em.set_footer(text=em.footer.text + " - Couldn't check PluralKit")
+            em.timestamp = utc_now()
+
+            self.bot.log_queue.put(embed=em)
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        if payload.guild_id != GUILD_ID or payload.channel_id == LOG_ID:
+            return
+
+        # /purge logs its own transcript, so only log whatever else was in there
+        message_ids = payload.message_ids - self.bot.purging
+        self.bot.purging.difference_update(payload.message_ids)
+
+        # One entry for the lot, with whatever we have as a transcript. PK never bulk deletes so no checks needed
+        cached = {message.id: message for message in payload.cached_messages}
+        messages = [self.stored_message(message_id, cached.get(message_id)) for message_id in message_ids]
+        messages = sorted((message for message in messages if message), key=lambda message: message.id)
+        for message_id in payload.message_ids:
+            self.messages.pop(message_id)
+        if not message_ids:
             return
 
-        desc = f"🗑️ **Message from {message.author.mention} deleted in {message.channel.mention}**\n" \
-               f"{_crop(message.content)}"
+        desc = f"🗑️ **{len(message_ids)} messages bulk deleted in <#{payload.channel_id}>**\n"
+        desc += f"{len(messages)} of them are in the attached transcript" if messages else \
+            "None of them were stored so there's no transcript"
         em = discord.Embed(description=desc, colour=DELETE)
-        em.set_author(name=message.author.display_name, icon_url=message.author.display_avatar.url)
-        em.set_footer(text=f"User ID: {message.author.id}")
         em.timestamp = utc_now()
 
-        channel = self.bot.get_channel(LOG_ID)
-        await channel.send(embed=em)
+        file = None
+        if messages:
+            transcript = TranscriptWriter(formatter=format_stored)
+            await transcript.add(messages)
+            file = await transcript.to_file("bulk_deleted")
+        self.bot.log_queue.put(embed=em, file=file)
 
     @commands.Cog.listener()
-    async def on_message_edit(self, old_message: discord.Message, message: discord.Message):
-        if not message.guild or message.guild.id != GUILD_ID:
-            return
-        if message.author.bot:  # ignore bots
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        if payload.guild_id != GUILD_ID or payload.channel_id == LOG_ID:
             return
-        if old_message.content == message.content:
+        if "content" not in payload.data:  # Embeds loading in etc.
             return
-        if message.channel.id == LOG_ID:
+
+        message = self.stored_message(payload.message_id, payload.cached_message)
+        content = payload.data["content"]
+        if not message or message.content == content:
             return
+        old_content = message.content
+        self.messages.edit(payload.message_id, content)
 
-        em = discord.Embed(colour=EDIT, url=message.jump_url,
-                           description=f"✏ **Message from {message.author.mention} edited in "
-                                       f"{message.channel.mention}**")
-        em.set_author(name=message.author.display_name, icon_url=message.author.display_avatar.url)
+        jump_url = f"https://discord.com/channels/{payload.guild_id}/{payload.channel_id}/{payload.message_id}"
+        em = discord.Embed(colour=EDIT, url=jump_url,
+                           description=f"✏ **Message from <@{message.author_id}> edited in "
+                                       f"<#{payload.channel_id}>**")
+        self.set_author(em, message)
 
-        em.add_field(name="Old", value=_crop(old_message.content, chars=1024), inline=False)
-        em.add_field(name="New", value=_crop(message.content, chars=1024), inline=False)
-        em.set_footer(text=f"User ID: {message.author.id}")
+        em.add_field(name="Old", value=_crop(old_content, chars=1024), inline=False)
+        em.add_field(name="New", value=_crop(content, chars=1024), inline=False)
         em.timestamp = utc_now()
-        channel = self.bot.get_channel(LOG_ID)
-        await channel.send(embed=em)
+        self.bot.log_queue.put(embed=em)
 
-    @commands.Cog.listener()
-    async def on_member_update(self, old: discord.Member, new: discord.Member):
+    async def member_updated(self, update: MemberUpdate):
+        new = update.new
         if new.guild.id != GUILD_ID:
             return
 
-        channel = self.bot.get_channel(LOG_ID)
-
-        if old.display_name != new.display_name:  # if nickname changed
+        if update.nick_changed:  # if nickname changed
             em = discord.Embed(colour=NICKNAME, description=f"✏ **{new.mention}'s nickname was changed**")
             em.set_author(name=new.display_name, icon_url=new.display_avatar.url)
             em.set_footer(text=f"User ID: {new.id}")
-            em.add_field(name="Old", value=old.display_name, inline=False)
+            em.add_field(name="Old", value=update.old.display_name, inline=False)
             em.add_field(name="New", value=new.display_name, inline=False)
             em.timestamp = utc_now()
 
-            await channel.send(embed=em)
-
-        elif old.roles != new.roles:  # if roles were changed
-            removed_roles = [role.mention for role in old.roles if role not in new.roles]
-            added_roles = [role.mention for role in new.roles if role not in old.roles]
+            self.bot.log_queue.put(embed=em)
 
-            if not added_roles and not removed_roles:
-                return
+        elif update.roles_changed:  # if roles were changed
+            # Still in role order
+            added_roles = [role.mention for role in new.roles if role.id in update.added]
+            removed_roles = [role.mention for role in update.old.roles if role.id in update.removed]
 
             # format embed
 
@@ -137,7 +285,7 @@ class Log(commands.Cog):
             if removed_roles:
                 em.add_field(name="Removed", value=" ".join(removed_roles), inline=False)
 
-            await channel.send(embed=em)
+            self.bot.log_queue.put(embed=em)
 
     @commands.Cog.listener()
     async def on_member_join(self, member: discord.Member):
@@ -149,14 +297,17 @@ class Log(commands.Cog):
         em.set_footer(text=f"User ID: {member.id}")
         em.timestamp = utc_now()
 
-        invite, inviter = await self.calc_member_invite()
-        if inviter and invite:
-            em.add_field(name="Invite:", value=f"Joined using invite {invite} - {inviter.mention}")
-        elif invite:
-            em.add_field(name="Invite:", value=f"Joined using invite {invite}")
+        used = await self.calc_member_invite()
+        if len(used) == 1:
+            (invite, inviter), = used
+            if inviter:
+                em.add_field(name="Invite:", value=f"Joined using invite {invite} - {inviter.mention}")
+            else:
+                em.add_field(name="Invite:", value=f"Joined using invite {invite}")
+        elif used:  # Several people joined at once using different invites, so we can't say which was whose
+            em.add_field(name="Invite:", value="Joined using one of " + ", ".join(invite for invite, _ in used))
 
-        channel = self.bot.get_channel(LOG_ID)
-        await channel.send(embed=em)
+        self.bot.log_queue.put(embed=em)
 
     @commands.Cog.listener()
     async def on_member_remove(self, member: discord.Member):
@@ -168,8 +319,7 @@ class Log(commands.Cog):
         em.set_footer(text=f"User ID: {member.id}")
         em.timestamp = utc_now()
 
-        channel = self.bot.get_channel(LOG_ID)
-        await channel.send(embed=em)
+        self.bot.log_queue.put(embed=em)
 
     @commands.Cog.listener()
     async def on_command_error(self, ctx: commands.Context, error: Exception):
@@ -220,12 +370,57 @@ class Log(commands.Cog):
             em.timestamp = utc_now()
             await ctx.send(embed=em)
 
-            # TODO - Ideally we would send as many lines of the traceback as we can fit
-            error_text = traceback(error)
-            # Will send the traceback if we have enough space, otherwise just send what the error was
-            content = f"Error in {ctx.message.jump_url}\n```{error_text if len(error_text) < 1500 else error}```"
-            channel = self.bot.get_channel(LOG_ID)
-            await channel.send(content)
+            self.errors.report(error, ctx.message.jump_url)
+
+    @commands.Cog.listener()
+    async def on_application_command_error(self, ctx: discord.ApplicationContext, error: discord.DiscordException):
+        """
+        Handle all errors from slash and context menu commands by default
+        """
+        if ctx.command and ctx.command.has_error_handler():
+            # if command handles its own errors
+            return
+        error = getattr(error, "original", error)  # strip traceback
+
+        if isinstance(error, commands.CommandOnCooldown):
+            title = "Command on cooldown"
+            desc = f"Try again in {ceil(error.retry_after)} seconds"
+        elif isinstance(error, (discord.CheckFailure, commands.CheckFailure)):
+            title = "You can't use this command here"
+            desc = None
+        elif isinstance(error, discord.Forbidden):
+            title = "A permissions error occurred"
+            desc = None
+        else:  # Unknown/unhandled exception
+            title = "Unknown Error Occurred"
+            desc = None
+            command = ctx.command.qualified_name if ctx.command else "unknown command"
+            self.errors.report(error, f"/{command} in {ctx.channel.mention if ctx.channel else 'DMs'}")
+
+        em = discord.Embed(colour=RED, title=f"⛔ Error: {title}", description=desc)
+        em.timestamp = utc_now()
+        try:
+            await ctx.respond(embed=em, ephemeral=True)
+        except discord.HTTPException:
+            pass
+
+    @discord.slash_command()
+    @discord.default_permissions(manage_messages=True)
+    async def logstats(self, ctx: discord.ApplicationContext):
+        """
+        See how far behind the log channel is
+        """
+        queue = self.bot.log_queue
+        per_message = queue.sent / queue.messages if queue.messages else 0
+
+        em = discord.Embed(colour=MODERATION, title="📜 Log queue", timestamp=utc_now())
+        em.add_field(name="Queued", value=f"{queue.depth} (oldest {queue.oldest:.1f}s)")
+        em.add_field(name="Sent", value=f"{queue.sent} in {queue.messages} messages ({per_message:.1f} per message)")
+        em.add_field(name="Dropped", value=str(queue.dropped))
+        em.add_field(name="Lag", value=queue.lag.summary(), inline=False)
+        em.add_field(name="PluralKit lookups", value=self.pk.stats(), inline=False)
+        em.add_field(name="Message store", value=self.messages.stats(), inline=False)
+        await ctx.respond(embed=em)
 
     """Invite tracking"""
 
@@ -235,7 +430,7 @@ class Log(commands.Cog):
 
         invite_data = {}
         for invite in invites:
-            invite_data.update({invite.id: (invite.uses, invite.inviter)})
+            invite_data.update({invite.id: (invite.uses, invite.inviter, invite.max_uses)})
 
         return invite_data
 
@@ -245,28 +440,59 @@ class Log(commands.Cog):
 
     @commands.Cog.listener()
     async def on_load(self, cog):
-        if cog + ".py" == __import__("os").path.basename(__file__):  # if cog is this file
+        if cog + ".py" == os.path.basename(__file__):  # if cog is this file
             self.invite_cache = await self.get_invites()
 
-    async def calc_member_invite(self):
+    @commands.Cog.listener()
+    async def on_invite_create(self, invite: discord.Invite):
+        if invite.guild and invite.guild.id == GUILD_ID:
+            self.invite_cache[invite.id] = (invite.uses or 0, invite.inviter, invite.max_uses)
+
+    @commands.Cog.listener()
+    async def on_invite_delete(self, invite: discord.Invite):
+        if invite.guild and invite.guild.id == GUILD_ID and invite.id in self.invite_cache:
+            self.deleted_invites[invite.id] = (time.monotonic(), self.invite_cache.pop(invite.id))
+
+    async def calc_member_invite(self) -> list:
+        """
+        Work out which invites were used by the joins in the current window, as a list of (invite, inviter)
+        Everyone joining in the same window shares one invites() fetch and gets the same answer
+        """
+        if self.invite_check is None:
+            self.invite_check = self.bot.loop.create_task(self.diff_invites())
+        return await asyncio.shield(self.invite_check)  # Shielded so one join being cancelled doesn't cancel the rest
+
+    async def diff_invites(self) -> list:
         """
-        When a member joins, hopefully an existing invite has +1 uses, or a new invite will exist with 1 usage
-        Otherwise it's a one time invite, vanity url or a discord moment:tm:
+        Compare invite uses against the cache
+        An existing invite with more uses, a new one with uses or a deleted one time invite were used
+        Otherwise it's a vanity url or a discord moment:tm:
         """
-        current = await self.get_invites()
-
-        for invite, (uses, inviter) in current.items():
-            if invite in self.invite_cache:  # Existing invite
-                if uses == self.invite_cache[invite][0] + 1:  # +1 uses from the last cache
-                    self.invite_cache = current
-                    return invite, inviter
-            else:  # New invite
-                if uses == 1:
-                    self.invite_cache = current
-                    return invite, inviter
+        # Only deletions around this group of joins count, one revoked hours ago wasn't used by any of them
+        # The delete event can come in just before the join, hence starting a window early
+        cutoff = max(self.last_invite_fetch, time.monotonic() - INVITE_WINDOW)
+        await asyncio.sleep(INVITE_WINDOW)
+        self.invite_check = None  # Joins from now on are part of the next window
+
+        self.last_invite_fetch = time.monotonic()
+        deleted = {invite: data for invite, (deleted_at, data) in self.deleted_invites.items() if deleted_at >= cutoff}
+        self.deleted_invites = {}
+        try:
+            current = await self.get_invites()
+        except discord.HTTPException as e:
+            print(f"Failed to fetch invites: {e}")
+            return []
+
+        used = []
+        for invite, (uses, inviter, _) in sorted(current.items()):
+            if uses > self.invite_cache.get(invite, (0,))[0]:
+                used.append((invite, inviter))
+        for invite, (uses, inviter, max_uses) in sorted(deleted.items()):
+            if max_uses and uses + 1 >= max_uses:  # Used up rather than revoked
+                used.append((invite, inviter))
 
         self.invite_cache = current
-        return None, None
+        return used
 
 
 def setup(bot):
@@ -1,6 +1,9 @@
 from discord.ext import commands
 import discord
 from time import perf_counter
+from config import MAIN
+from utils.db_utils import index_report, timings, cache
+from utils.utils import latencies
 
 
 class Meta(commands.Cog):
@@ -19,6 +22,69 @@ class Meta(commands.Cog):
         msg = f"Pong!\nDiscord latency: {self.bot.latency * 1000:.0f}ms\nBot Latency: {duration:.0f}ms"
         await message.edit_original_message(content=msg)
 
+    @discord.slash_command()
+    @discord.default_permissions(manage_messages=True)
+    async def dbstats(self, ctx: discord.ApplicationContext):
+        """
+        Show database latency per collection and operation
+        """
+        em = discord.Embed(colour=MAIN, title="⏱️ Database Latency")
+
+        # Slowest first, embeds only fit 25 fields
+        by_p95 = sorted(timings.items(), key=lambda item: item[1].percentile(95), reverse=True)
+        for (collection, operation), timing in by_p95[:24]:
+            em.add_field(name=f"{collection}.{operation}", value=timing.summary(), inline=False)
+
+        if not timings:
+            em.description = "No database calls since startup"
+
+        stats = cache.stats()
+        em.add_field(name="Document cache", inline=False,
+                     value=f"{stats['size']}/{stats['max_size']} docs | {stats['hits']} hits {stats['misses']} misses "
+                           f"({stats['hit_rate']:.0%})")
+
+        await ctx.respond(embed=em, ephemeral=True)
+
+    @discord.slash_command()
+    @discord.default_permissions(manage_messages=True)
+    async def latency(self, ctx: discord.ApplicationContext):
+        """
+        Show how long the bot takes to respond for things being tracked
+        """
+        em = discord.Embed(colour=MAIN, title="⏱️ Bot Latency")
+
+        by_p95 = sorted(latencies.items(), key=lambda item: item[1].percentile(95), reverse=True)
+        for name, timing in by_p95[:25]:
+            em.add_field(name=name, value=timing.summary(), inline=False)
+
+        if not latencies:
+            em.description = "Nothing recorded since startup"
+
+        await ctx.respond(embed=em, ephemeral=True)
+
+    @discord.slash_command()
+    @discord.default_permissions(manage_guild=True)
+    async def dbindexes(self, ctx: discord.ApplicationContext):
+        """
+        Show declared db indexes and any queries that aren't covered by one
+        """
+        declared, uncovered = index_report()
+
+        em = discord.Embed(colour=MAIN, title="🗂️ Database Indexes")
+        for collection, names in declared.items():
+            em.add_field(name=collection, value="\n".join(f"`{name}`" for name in names))
+
+        if uncovered:
+            lines = []
+            for (collection, fields, sort), count in uncovered[:15]:
+                sort = f" sort {', '.join(sort)}" if sort else ""
+                lines.append(f"`{collection}` on {', '.join(fields) or 'nothing'}{sort} - {count}x")
+            em.add_field(name="⚠️ Uncovered queries", value="\n".join(lines), inline=False)
+        else:
+            em.add_field(name="✅ Uncovered queries", value="None seen since startup", inline=False)
+
+        await ctx.respond(embed=em, ephemeral=True)
+
 
 def setup(bot):
     bot.add_cog(Meta(bot))
@@ -1,17 +1,157 @@
 import discord
-from discord.ext import commands, tasks
-from config import RED, YELLOW, LOG_ID, GUILD_ID, APPEAL_URL
+from discord.ext import commands
+from config import RED, YELLOW, GUILD_ID, APPEAL_URL
 from cogs.logs import MODERATION
-from utils.utils import format_time, utc_now
-from utils.db_utils import insert_doc, find_docs, del_doc
+from utils.utils import format_time, utc_now, Page, LazyPage, latencies, chunks, _crop, traceback
+from utils.transcript import TranscriptWriter
+from utils.db_utils import get_doc, insert_doc, iter_docs, count_docs, del_doc, declare_index, increment, \
+    update_doc, aggregate, insert_docs, find_docs
 import datetime as dt
 from typing import Union
-from random import randint
-import re
 from config import GREEN
-from io import BytesIO
+from math import ceil
+from io import BytesIO, StringIO
+import asyncio
+import csv
+import json
+import heapq
+import re
+import time
+
+MODLOGS_PER_PAGE = 5
+PURGE_CHUNK = 100  # Max messages per bulk delete
+PURGE_PROGRESS_INTERVAL = 3  # Seconds between progress updates
+PURGE_EVENT_GRACE = 60  # Seconds to wait for the delete events of purged messages before forgetting their IDs
+BULK_DELETE_MAX_AGE = dt.timedelta(days=14) - dt.timedelta(minutes=1)  # Discord won't bulk delete older messages
+MASS_ACTION_CONCURRENCY = 5  # Bans/timeouts in flight at once during /massban and /masstimeout
+MASS_ACTION_MAX_MINUTES = 24 * 60  # Furthest back joined_minutes can go, a raid doesn't last longer than this
+MASS_ACTION_PREVIEW = 20  # Targets listed when asking to confirm a mass action
+CONFIRM_TIMEOUT = 60  # Seconds to wait for a mass action to be confirmed
+DM_TIMEOUT = 5  # Seconds to wait on a DM before giving up on it
+UNBAN_LOAD_RETRY = 5  # Seconds before retrying a failed load of pending temp bans, doubled each time
+UNBAN_LOAD_MAX_RETRY = 5 * 60
+MODSTATS_TTL = 5 * 60  # Seconds to reuse /modstats results for
+LOG_TYPES = ["warn", "timeout", "ban", "note"]
+SEARCH_LIMIT = 50  # Best matches shown by /searchlogs
+EXPORT_BATCH = 500  # Mod log entries formatted per thread hop during /exportlogs
+EXPORT_FIELDS = ["case", "legacy_case", "user", "mod", "type", "duration", "reason", "timestamp"]
+
+# counters.doc[CASE_COUNTER].seq is the last case number handed out
+CASE_COUNTER = f"cases:{GUILD_ID}"
+LEGACY_CASE_MAX = 9999  # Old random case IDs were 0000-9999, new case numbers start above them so the two can't clash
+
+declare_index("mod_logs", [("user", 1), ("timestamp", -1)])  # /modlogs
+# Case numbers used to be random 4 digit strings which can collide, so only enforce uniqueness for the new ones
+declare_index("mod_logs", [("case", 1)], unique=True, partialFilterExpression={"case": {"$type": "number"}})
+declare_index("mod_logs", [("legacy_case", 1)])  # Old case IDs, kept by /migratecases
+declare_index("mod_logs", [("type", 1), ("timestamp", -1)])  # /modstats filters
+declare_index("mod_logs", [("mod", 1), ("timestamp", -1)])  # Filtering by mod in /exportlogs and /searchlogs
+declare_index("mod_logs", [("reason", "text")])  # /searchlogs
+declare_index("pending", [("type", 1), ("timestamp", 1)])  # Temp bans, loaded in expiry order at startup
+
+
+_counter_checked = False
+
+
+async def next_case_numbers(count: int = 1) -> range:
+    """Reserve count sequential case numbers"""
+    global _counter_checked
+    if not _counter_checked:
+        # $max only ever raises it, so this just moves a new (or too low) counter past the old IDs
+        await update_doc(CASE_COUNTER, "counters", {"$max": {"seq": LEGACY_CASE_MAX}}, upsert=True)
+        _counter_checked = True
+
+    last = await increment(CASE_COUNTER, "counters", "seq", count)
+    return range(last - count + 1, last + 1)
+
+
+async def find_cases(case_number: str, user_id: str = None) -> list:
+    """
+    Look up a case by its number, optionally only for one user
+    Falls back to the old random case IDs, either not migrated yet or kept as legacy_case by /migratecases
+    Those could collide, so this returns up to 2 matches and callers should check there's only one
+    """
+    if not case_number.isdigit():
+        return []
+
+    user = {"user": user_id} if user_id else {}
+    cases = await find_docs("mod_logs", {"case": int(case_number), **user}, 2)
+    if not cases and len(case_number) <= 4:
+        legacy = case_number.zfill(4)
+        cases = await find_docs("mod_logs", {"$or": [{"legacy_case": legacy}, {"case": legacy}], **user}, 2)
+    return cases
+
+
+def case_description(case: dict):
+    duration = dt.timedelta(seconds=case["duration"]) if case.get("duration") else None
+    duration = f"**Duration:** {format_time(duration)}\n" if duration else ""  # Don't show if no duration
+
+    legacy = f"**Old case #:** {case['legacy_case']}\n" if case.get("legacy_case") else ""
+
+    return f"**{case['type'].title()}**\n" \
+           f"**User:** <@{case['user']}>\n" \
+           f"**Reason:** {case['reason']}\n" \
+           f"{duration}" \
+           f"**Timestamp:** {discord.utils.format_dt(case['timestamp'])}\n" \
+           f"**Mod:** <@{case['mod']}>\n" \
+           f"{legacy}"
+
+
+def entry_text(entry: dict, show_user: bool = False) -> str:
+    """A mod log entry as it's shown in lists like /modlogs"""
+    duration = dt.timedelta(seconds=entry["duration"]) if entry["duration"] else None
+    duration = f"**Duration:** {format_time(duration)}\n" if duration else ""  # Don't show if no duration
+    user = f"**User:** <@{entry['user']}>\n" if show_user else ""
+
+    return f"**Case #{entry['case']}: {entry['type'].title()}**\n" \
+           f"{user}" \
+           f"**Reason:** {_crop(entry['reason'] or 'None', chars=600)}\n" \
+           f"{duration}" \
+           f"**Timestamp:** {discord.utils.format_dt(entry['timestamp'])}\n" \
+           f"**Mod:** <@{entry['mod']}>"
+
+
+def parse_date(text: str) -> dt.datetime:
+    """YYYY-MM-DD to a UTC datetime, raises ValueError if it's not a date"""
+    return dt.datetime.strptime(text.strip(), "%Y-%m-%d").replace(tzinfo=dt.timezone.utc)
+
+
+def modlog_query(user: discord.abc.Snowflake = None, mod: discord.abc.Snowflake = None, log_type: str = None,
+                 after: str = None, before: str = None) -> dict:
+    """
+    Build a mod_logs filter from the usual command options. after and before are YYYY-MM-DD and both inclusive
+    Raises ValueError for a bad date
+    """
+    query = {}
+    if user:
+        query["user"] = str(user.id)
+    if mod:
+        query["mod"] = str(mod.id)
+    if log_type:
+        query["type"] = log_type
+    if after or before:
+        query["timestamp"] = {}
+        if after:
+            query["timestamp"]["$gte"] = parse_date(after)
+        if before:
+            query["timestamp"]["$lt"] = parse_date(before) + dt.timedelta(days=1)
+    return query
+
+
+def export_value(entry: dict, field: str):
+    value = entry.get(field)
+    return value.isoformat() if isinstance(value, dt.datetime) else value
+
+
+def modlog_csv(entry: dict) -> str:
+    row = StringIO()
+    csv.writer(row).writerow(["" if value is None else value for value in
+                              (export_value(entry, field) for field in EXPORT_FIELDS)])
+    return row.getvalue()
 
-EMBED_DESC_LIMIT = 4096
+
+def modlog_jsonl(entry: dict) -> str:
+    return json.dumps({field: export_value(entry, field) for field in EXPORT_FIELDS}) + "\n"
 
 
 async def add_modlog(user: Union[discord.Member, discord.User], mod: discord.Member, log_type: str, reason: str,
@@ -19,7 +159,7 @@ async def add_modlog(user: Union[discord.Member, discord.User], mod: discord.Mem
     if duration:
         duration = duration.total_seconds()
 
-    case_num = str(randint(0, 9999)).zfill(4)
+    case_num = (await next_case_numbers())[0]
 
     data = {
         "case": case_num,
@@ -31,10 +171,66 @@ async def add_modlog(user: Union[discord.Member, discord.User], mod: discord.Mem
         "timestamp": utc_now(),
     }
     await insert_doc("mod_logs", data)
+    # Only once the case is definitely saved, otherwise the summary counts something that isn't there
+    await update_summary(data["user"], log_type, data["timestamp"])
 
     return case_num
 
 
+async def update_summary(user_id: str, log_type: str, timestamp: dt.datetime = None, amount: int = 1,
+                         buffered: bool = False):
+    """
+    Keep mod_summary.doc[user_id] in step with their mod logs, amount is -1 when a case is removed
+    The doc is {"total": n, "counts": {type: n}, "last": {type: timestamp}}
+    """
+    update = {"$inc": {"total": amount, f"counts.{log_type}": amount}}
+    where = None
+    if amount > 0:
+        update["$max"] = {f"last.{log_type}": timestamp}
+    else:  # Never take a count below 0, e.g. if the summary was built after the case was already gone
+        where = {f"counts.{log_type}": {"$gte": -amount}}
+    await update_doc(user_id, "mod_summary", update, upsert=amount > 0, buffered=buffered, where=where)
+
+
+def summary_counts(summary: dict) -> str:
+    """e.g. 2 warns, 1 timeout"""
+    counts = (summary or {}).get("counts", {})
+    parts = [f"{counts[log_type]} {log_type}{'s' if counts[log_type] != 1 else ''}"
+             for log_type in LOG_TYPES if counts.get(log_type, 0) > 0]
+    return ", ".join(parts) if parts else "No mod history"
+
+
+async def dm_user(user: Union[discord.Member, discord.User], embed: discord.Embed) -> bool:
+    """
+    DM a user without letting a slow or closed DM hold things up. Returns whether it was sent
+    """
+    try:
+        await asyncio.wait_for(user.send(embed=embed), DM_TIMEOUT)
+    except (discord.HTTPException, asyncio.TimeoutError):
+        return False
+    return True
+
+
+async def side_effects(*coros) -> list:
+    """
+    Run independent follow up work at the same time, one failing doesn't stop the rest
+    Failures are printed and returned in place of their result
+    """
+    results = await asyncio.gather(*coros, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"Side effect failed:\n{traceback(result)}")
+    return results
+
+
+def case_footer(case_num, can_dm, summary: dict = None) -> str:
+    """Footer for a mod action response, once the side effects have finished"""
+    text = "Failed to save the case" if isinstance(case_num, Exception) else f"Case #{case_num}"
+    if can_dm is not True:
+        text += " - Unable to dm user"
+    return text + f"\nHistory: {summary_counts(summary)}"
+
+
 async def can_moderate_user(ctx: discord.ApplicationContext, member: discord.Member):
     em = discord.Embed(color=RED, timestamp=utc_now())
 
@@ -158,34 +354,268 @@ class ReasonModal(discord.ui.Modal):
         )
 
 
-def messages_to_file(messages: list[discord.Message]) -> discord.File:
-    output = ""
+class PurgeJob:
+    """
+    Deletes matching messages from a channel, newest first, in chunks of up to 100
+    Recent messages are bulk deleted, anything too old for that is deleted one at a time
+    (the http client waits out rate limits for us)
+    """
+
+    def __init__(self, channel: discord.TextChannel, count: int, check, transcript: TranscriptWriter,
+                 purging: set, before: discord.Object = None, after: discord.Object = None, skip: int = None):
+        self.channel = channel
+        self.purging = purging  # bot.purging, the IDs being deleted go in here so the delete logs skip them
+        self.ids = set()
+        self.count = count
+        self.check = check
+        self.transcript = transcript
+        self.before = before
+        self.after = after
+        self.skip = skip  # Message ID to leave alone, i.e. our progress message
+
+        self.scanned = 0
+        self.deleted = 0
+        self.cancelled = False
+
+    async def delete_chunk(self, messages: list):
+        cutoff = utc_now() - BULK_DELETE_MAX_AGE
+        recent = [message for message in messages if message.created_at > cutoff]
+        old = [message for message in messages if message.created_at <= cutoff]
+
+        # Registered up front, as the delete events can arrive before the request returns
+        ids = {message.id for message in messages}
+        self.ids |= ids
+        self.purging |= ids
+
+        if recent:
+            await self.channel.delete_messages(recent)
+
+        deleted = recent
+        for message in old:
+            if self.cancelled:
+                break
+            try:
+                await message.delete()
+            except discord.NotFound:  # Someone beat us to it
+                continue
+            deleted.append(message)
+
+        self.deleted += len(deleted)
+        await self.transcript.add(deleted)
+
+    async def run(self):
+        try:
+            await self.purge()
+        finally:
+            # The delete logs discard IDs as their events come in, this catches any that never do
+            asyncio.get_running_loop().call_later(PURGE_EVENT_GRACE, self.purging.difference_update, self.ids)
+
+    async def purge(self):
+        chunk = []
+        matched = 0
+
+        # Passing after on its own would make history go oldest first
+        async for message in self.channel.history(limit=None, before=self.before, after=self.after,
+                                                      oldest_first=False):
+            if self.cancelled:
+                break
+
+            self.scanned += 1
+            if message.id == self.skip or not self.check(message):
+                continue
+
+            chunk.append(message)
+            matched += 1
+
+            if len(chunk) == PURGE_CHUNK:
+                await self.delete_chunk(chunk)
+                chunk = []
+            if matched >= self.count:
+                break
+
+        if chunk and not self.cancelled:
+            await self.delete_chunk(chunk)
+
+
+class PurgeCancel(discord.ui.View):
+    def __init__(self, job: PurgeJob, author: discord.Member):
+        super().__init__(timeout=None)
+        self.job = job
+        self.author = author
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        return interaction.user.id == self.author.id or interaction.user.guild_permissions.manage_messages
+
+    @discord.ui.button(label="Cancel", emoji="✋", style=discord.ButtonStyle.danger)
+    async def cancel(self, _button: discord.ui.Button, interaction: discord.Interaction):
+        self.job.cancelled = True
+        self.stop()
+        await interaction.response.send_message("Stopping the purge...", ephemeral=True)
+
+
+class Confirm(discord.ui.View):
+    """Confirm/cancel buttons only the mod who ran the command can use. confirmed is set once it's stopped"""
+
+    def __init__(self, author: discord.Member):
+        super().__init__(timeout=CONFIRM_TIMEOUT)
+        self.author = author
+        self.confirmed = False
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        return interaction.user.id == self.author.id
+
+    @discord.ui.button(label="Confirm", style=discord.ButtonStyle.danger)
+    async def confirm(self, _button: discord.ui.Button, interaction: discord.Interaction):
+        self.confirmed = True
+        self.stop()
+        await interaction.response.defer()
+
+    @discord.ui.button(label="Cancel", style=discord.ButtonStyle.secondary)
+    async def cancel(self, _button: discord.ui.Button, interaction: discord.Interaction):
+        self.stop()
+        await interaction.response.defer()
+
+
+class ModLogPages:
+    """
+    Fetches a member's mod logs a page at a time, newest first
+    Pages are found with range queries on (timestamp, _id) from a neighbouring page that has already been fetched,
+    so viewing a page never reads any entries other than its own
+    """
+
+    def __init__(self, member: discord.Member, count: int):
+        self.member = member
+        self.count = count
+        self.max_page = max(1, ceil(count / MODLOGS_PER_PAGE))
+        self.bounds = {}  # page index -> (newest key, oldest key) where a key is (timestamp, _id)
+
+    async def fetch(self, index: int) -> list:
+        query = {"user": str(self.member.id)}
+        limit = MODLOGS_PER_PAGE
+        newest_first = True
+
+        if index - 1 in self.bounds:  # Entries older than the previous page
+            timestamp, _id = self.bounds[index - 1][1]
+            query["$or"] = [{"timestamp": {"$lt": timestamp}}, {"timestamp": timestamp, "_id": {"$lt": _id}}]
+        elif index + 1 in self.bounds:  # Entries newer than the next page
+            timestamp, _id = self.bounds[index + 1][0]
+            query["$or"] = [{"timestamp": {"$gt": timestamp}}, {"timestamp": timestamp, "_id": {"$gt": _id}}]
+            newest_first = False
+        elif index == self.max_page - 1 and index != 0:  # Last page, the oldest entries
+            limit = self.count - index * MODLOGS_PER_PAGE
+            newest_first = False
+        # Otherwise it's the first page
+
+        direction = -1 if newest_first else 1
+        entries = [entry async for entry in
+                   iter_docs("mod_logs", query, sort=[("timestamp", direction), ("_id", direction)], limit=limit,
+                             projection={"user": 0})]
+        if not newest_first:
+            entries.reverse()
+
+        if entries:
+            self.bounds[index] = ((entries[0]["timestamp"], entries[0]["_id"]),
+                                  (entries[-1]["timestamp"], entries[-1]["_id"]))
+        return entries
+
+    async def embed(self, index: int) -> discord.Embed:
+        text = [entry_text(entry) for entry in await self.fetch(index)]
+
+        em = discord.Embed(colour=RED, timestamp=utc_now(), title=f"Mod Logs: {self.count} Entries",
+                           description="\n\n".join(text) if text else "No entries")
+        em.set_author(name=self.member.display_name, icon_url=self.member.display_avatar.url)
+        return em
+
+
+class UnbanScheduler:
+    """
+    Keeps pending temp ban expiries in a min heap and sleeps until exactly when the next one is due
+    Adding a ban wakes the scheduler up, so a ban shorter than the current wait still happens on time
+    """
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+        self.heap = []  # (unban time, pending _id, user id)
+        self.scheduled = set()  # pending _ids in the heap
+        self.wakeup = asyncio.Event()
 
-    for message in messages[::-1]:
-        output += f"{message.created_at.isoformat()} | {message.author} ({message.author.id})\n"
+    def add(self, timestamp: dt.datetime, _id, user_id: int):
+        if _id in self.scheduled:
+            return
+        if not timestamp.tzinfo:  # The db gives back naive utc
+            timestamp = timestamp.replace(tzinfo=dt.timezone.utc)
 
-        content = []
-        if message.embeds and message.embeds[0].type == "rich":
-            content.append("[embed]")
-        if message.attachments:
-            content.append("[file]")
-        if message.content:
-            content.append(message.content)
+        heapq.heappush(self.heap, (timestamp, _id, user_id))
+        self.scheduled.add(_id)
+        self.wakeup.set()
 
-        output += " | ".join(content) + "\n\n"
+    async def load(self):
+        async for ban in iter_docs("pending", {"type": "ban"}, projection={"user": 1, "timestamp": 1},
+                                   sort=[("timestamp", 1)]):
+            self.add(ban["timestamp"], ban["_id"], int(ban["user"]))
 
-    file = BytesIO()
+    async def run(self):
+        await self.bot.wait_until_ready()
+
+        retry = UNBAN_LOAD_RETRY
+        while True:
+            try:
+                await self.load()
+                break
+            except Exception as e:  # Most likely the db being unreachable, don't lose every temp ban over it
+                print(f"Failed to load pending temp bans, retrying in {retry}s: {e!r}")
+                await asyncio.sleep(retry)
+                retry = min(retry * 2, UNBAN_LOAD_MAX_RETRY)
 
-    file.write(output.encode())
-    file.seek(0)
+        while True:
+            self.wakeup.clear()
+
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+
+            delay = (self.heap[0][0] - utc_now()).total_seconds()
+            if delay > 0:
+                try:
+                    # Sleep until the next unban, unless something new gets added first
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            timestamp, _id, user_id = heapq.heappop(self.heap)
+            self.scheduled.discard(_id)
+            try:
+                await self.unban(timestamp, _id, user_id)
+            except Exception as e:  # Don't let one bad entry stop every other unban
+                print(f"Error processing temp ban {_id}: {e}")
+
+    async def unban(self, timestamp: dt.datetime, _id, user_id: int):
+        guild = self.bot.get_guild(GUILD_ID)
+        try:
+            await guild.unban(discord.Object(user_id), reason="Temp ban")
+        except discord.NotFound:
+            # If the user is not banned, just delete the entry
+            # Could have been manually unbanned
+            pass
+        except discord.HTTPException as e:
+            # Try again in a minute rather than losing the unban
+            print(f"Failed to unban {user_id}, retrying: {e}")
+            self.add(utc_now() + dt.timedelta(minutes=1), _id, user_id)
+            return
 
-    return discord.File(file, filename="purged_messages.txt")
+        await del_doc(_id, "pending")
 
 
 class Moderation(commands.Cog):
     def __init__(self, bot):
         self.bot = bot  # type: commands.Bot
-        self.unban_loop.start()
+
+        self.unbans = UnbanScheduler(bot)
+        self.unban_task = bot.loop.create_task(self.unbans.run())
+
+    def cog_unload(self):
+        self.unban_task.cancel()
 
     async def mod_action_embed(self, title=discord.Embed.Empty, desc=discord.Embed.Empty,
                                author: discord.Member = None, target: Union[discord.Member, discord.User] = None,
@@ -203,30 +633,96 @@ class Moderation(commands.Cog):
             for name, value in fields.items():
                 em.add_field(name=name, value=value)
 
-        channel = self.bot.get_channel(LOG_ID)
-        await channel.send(embed=em, file=file)
+        self.bot.log_queue.put(embed=em, file=file)
 
     @discord.slash_command()
     @discord.default_permissions(manage_messages=True)
-    async def purge(self, ctx: discord.ApplicationContext, count: int):
+    @discord.option("author", discord.User, description="Only purge messages from this user", required=False)
+    @discord.option("contains", str, description="Only purge messages containing this text", required=False)
+    @discord.option("attachments", bool, description="Only purge messages with attachments", required=False)
+    @discord.option("before", str, description="Only purge messages before this message ID", required=False)
+    @discord.option("after", str, description="Only purge messages after this message ID", required=False)
+    @discord.option("transcript", description="Format of the logged transcript (default: text)", required=False,
+                    choices=[
+                        discord.OptionChoice(name="Text", value="txt"),
+                        discord.OptionChoice(name="JSON Lines", value="jsonl"),
+                    ])
+    async def purge(self, ctx: discord.ApplicationContext, count: int, author: discord.User = None,
+                    contains: str = None, attachments: bool = False, before: str = None, after: str = None,
+                    transcript: str = "txt"):
         """
         Purge messages in this channel
         """
         if count < 1:
             await ctx.respond("Count must be greater than 0", ephemeral=True)
             return
+        if (before and not before.isdigit()) or (after and not after.isdigit()):
+            await ctx.respond("`before` and `after` must be message IDs", ephemeral=True)
+            return
+
+        def check(message: discord.Message):
+            if author and message.author.id != author.id:
+                return False
+            if contains and contains.lower() not in message.content.lower():
+                return False
+            if attachments and not message.attachments:
+                return False
+            return True
 
-        messages = await ctx.channel.purge(limit=count + 1)  # +1 to account for the ctx message
-        em = discord.Embed(colour=RED, description=f"{ctx.author.mention} purged {count} messages!")
+        em = discord.Embed(colour=RED, description=f"🔥 Purging up to {count} messages...")
         em.set_footer(icon_url=ctx.guild.icon.url, text=ctx.guild.name)
         em.timestamp = utc_now()
-        await ctx.respond(embed=em)
+
+        job = PurgeJob(ctx.channel, count, check, TranscriptWriter(transcript), self.bot.purging,
+                       before=discord.Object(int(before)) if before else None,
+                       after=discord.Object(int(after)) if after else None)
+        view = PurgeCancel(job, ctx.author)
+        response = await ctx.respond(embed=em, view=view)
+        response = await response.original_response() if isinstance(response, discord.Interaction) else response
+        job.skip = response.id
+        # Edit through the channel rather than the interaction, which expires after 15 minutes
+        progress = ctx.channel.get_partial_message(response.id)
+
+        async def report_progress():
+            while True:
+                await asyncio.sleep(PURGE_PROGRESS_INTERVAL)
+                em.description = f"🔥 Purging... {job.deleted}/{count} deleted ({job.scanned} messages checked)"
+                try:
+                    await progress.edit(embed=em)
+                except discord.HTTPException:
+                    pass
+
+        reporter = asyncio.create_task(report_progress())
+        error = None
+        try:
+            await job.run()
+        except Exception as e:  # Whatever got deleted before this still needs logging, re-raised at the end
+            error = e
+        finally:
+            reporter.cancel()
+            view.stop()  # It has no timeout, so otherwise the view store keeps it and the job forever
+
+        if error:
+            verb = "hit an error during a purge after deleting"
+        elif job.cancelled:
+            verb = "cancelled a purge after deleting"
+        else:
+            verb = "purged"
+        em.description = f"{ctx.author.mention} {verb} {job.deleted} messages!"
+        em.timestamp = utc_now()
+        try:
+            await progress.edit(embed=em, view=None)
+        except discord.HTTPException:
+            pass
 
         # Log action
-        file = messages_to_file(messages)
+        file = await job.transcript.to_file("purged_messages")
         await self.mod_action_embed(author=ctx.author, title="🔥 Purge",
-                                    desc=f"{ctx.author.mention} purged {count} messages in {ctx.channel.mention}",
+                                    desc=f"{ctx.author.mention} {verb} {job.deleted} messages in "
+                                         f"{ctx.channel.mention}\nTranscript is newest first",
                                     file=file)
+        if error:
+            raise error
 
     @discord.slash_command()
     @discord.default_permissions(moderate_members=True)
@@ -248,6 +744,8 @@ class Moderation(commands.Cog):
             return
 
         async def callback(interaction, reason):
+            start = time.perf_counter()
+
             # Combine unit/duration args
             duration = raw_duration * units
             duration = dt.timedelta(seconds=duration)
@@ -266,40 +764,41 @@ class Moderation(commands.Cog):
                 await interaction.followup.send("Unable to mute the user")
                 return
 
-            case_num = await add_modlog(member, ctx.author, "timeout", reason, duration)
-
             # Format duration
 
             duration_str = format_time(duration)
             end_time = utc_now() + duration
             dynamic_str = discord.utils.format_dt(end_time, "R")
 
-            # Contact user
-
-            em = discord.Embed(color=RED, timestamp=utc_now())
-            em.set_author(name=ctx.guild.name, icon_url=ctx.guild.icon.url)
-            em.description = f"You have been muted for {duration_str}\n```{reason}```"
-            can_dm = True
-            try:
-                await member.send(embed=em)
-            except discord.Forbidden:
-                can_dm = False
-
-            # Send response
+            # Send response straight away, the case number gets filled in after
 
             em = discord.Embed(color=YELLOW, timestamp=utc_now())
             em.set_author(name=member.display_name, icon_url=member.display_avatar.url)
 
             em.description = f"{member.mention} has been muted by {ctx.author.mention} for {duration_str}\n" \
                              f"Unmute: {dynamic_str}"
+            em.set_footer(text="Saving case...")
+            message = await interaction.followup.send(embed=em, wait=True)
+            latencies["mute followup"].record(time.perf_counter() - start)
 
-            em.set_footer(text=f"Case #{case_num}" + " - Unable to dm user" if not can_dm else "")
-            await interaction.followup.send(embed=em)
+            # Everything else
 
-            await self.mod_action_embed(author=ctx.author, target=member,
-                                        desc=f"**🔇 Muted {member.mention}**" +
-                                             (f" **for**:\n```{reason}```" if reason else ""),
-                                        fields={"Duration": duration_str, "Unmute": dynamic_str})
+            dm = discord.Embed(color=RED, timestamp=utc_now())
+            dm.set_author(name=ctx.guild.name, icon_url=ctx.guild.icon.url)
+            dm.description = f"You have been muted for {duration_str}\n```{reason}```"
+
+            case_num, can_dm, _ = await side_effects(
+                add_modlog(member, ctx.author, "timeout", reason, duration),
+                dm_user(member, dm),
+                self.mod_action_embed(author=ctx.author, target=member,
+                                      desc=f"**🔇 Muted {member.mention}**" +
+                                           (f" **for**:\n```{reason}```" if reason else ""),
+                                      fields={"Duration": duration_str, "Unmute": dynamic_str}),
+            )
+
+            summary = await get_doc(str(member.id), "mod_summary")
+            em.set_footer(text=case_footer(case_num, can_dm, summary))
+            await message.edit(embed=em)
 
         await reason_modal(ctx, callback)
 
@@ -334,27 +833,30 @@ class Moderation(commands.Cog):
             return
 
         async def callback(interaction, reason):
+            start = time.perf_counter()
             await interaction.response.defer()
 
-            case_num = await add_modlog(member, ctx.author, "warn", reason)
-
-            em = discord.Embed(color=RED, timestamp=utc_now())
-            em.set_author(name=ctx.guild.name, icon_url=ctx.guild.icon.url)
-            em.description = f"You have been warned for \n```{reason}```"
-            can_dm = True
-            try:
-                await member.send(embed=em)
-            except discord.Forbidden:
-                can_dm = False
-
             em = discord.Embed(color=RED, timestamp=utc_now())
             em.set_author(name=member.display_name, icon_url=member.display_avatar.url)
             em.description = f"{member.mention} was warned by {ctx.author.mention} for:\n```{reason}```"
-            em.set_footer(text=f"Case #{case_num}" + " - Unable to dm user" if not can_dm else "")
-            await ctx.followup.send(embed=em)
+            em.set_footer(text="Saving case...")
+            message = await ctx.followup.send(embed=em, wait=True)
+            latencies["warn followup"].record(time.perf_counter() - start)
+
+            dm = discord.Embed(color=RED, timestamp=utc_now())
+            dm.set_author(name=ctx.guild.name, icon_url=ctx.guild.icon.url)
+            dm.description = f"You have been warned for \n```{reason}```"
 
-            await self.mod_action_embed(author=ctx.author, target=member,
-                                        desc=f"**Warned {member.mention} for:**\n```{reason}```")
+            case_num, can_dm, _ = await side_effects(
+                add_modlog(member, ctx.author, "warn", reason),
+                dm_user(member, dm),
+                self.mod_action_embed(author=ctx.author, target=member,
+                                      desc=f"**Warned {member.mention} for:**\n```{reason}```"),
+            )
+
+            summary = await get_doc(str(member.id), "mod_summary")
+            em.set_footer(text=case_footer(case_num, can_dm, summary))
+            await message.edit(embed=em)
 
         await reason_modal(ctx, callback)
 
@@ -377,26 +879,27 @@ class Moderation(commands.Cog):
             return
 
         async def callback(interaction, reason):
+            start = time.perf_counter()
             await interaction.response.defer()
 
-            can_dm = True
+            can_dm = False
             if member:
                 if not await can_moderate_user(ctx, member):
                     return
 
+                # This has to happen before the ban, they can't be messaged once they don't share a server
                 em = discord.Embed(color=RED, timestamp=utc_now())
                 em.set_author(name=ctx.guild.name, icon_url=ctx.guild.icon.url)
                 em.description = f"You have been banned for \n```{reason}```"
                 em.add_field(name="Appeal link", value=f"[Please click here to appeal this ban]({APPEAL_URL})",
                              inline=False)
-                try:
-                    await user.send(embed=em)
-                except discord.Forbidden:
-                    can_dm = False
-            else:  # discord.User
-                can_dm = False
+                can_dm = await dm_user(user, em)
 
-            await ctx.guild.ban(user, reason=reason, delete_message_days=0)
+            try:
+                await ctx.guild.ban(user, reason=reason, delete_message_days=0)
+            except discord.Forbidden:
+                await ctx.followup.send("Unable to ban the user")
+                return
 
             duration = base_duration * units if base_duration and units else None
 
@@ -405,36 +908,257 @@ class Moderation(commands.Cog):
                 end_time = utc_now() + duration_delta
                 duration_str = format_time(duration_delta)
                 dynamic_str = discord.utils.format_dt(end_time, "R")
-
-                await insert_doc("pending", {
-                    "user": str(user.id),
-                    "timestamp": end_time,
-                    "type": "ban",
-                })
-                self.unban_loop.start()
             else:
                 # Mostly to satisfy IDEs
                 duration_delta = None
+                end_time = None
                 duration_str = None
                 dynamic_str = None
 
-            case_num = await add_modlog(user, ctx.author, "ban", reason, duration=duration_delta)
-
             em = discord.Embed(color=RED, timestamp=utc_now())
             em.set_author(name=user.display_name, icon_url=user.display_avatar.url)
             em.description = f"{user.mention} was banned by {ctx.author.mention}" + \
                              (f" for:\n```{reason}```" if reason else "")
-            em.set_footer(text=f"Case #{case_num}" + " - Unable to dm user" if not can_dm else "")
+            em.set_footer(text="Saving case...")
             if duration:
                 em.add_field(name="Duration", value=duration_str)
 
-            await ctx.followup.send(embed=em)
+            message = await ctx.followup.send(embed=em, wait=True)
+            latencies["ban followup"].record(time.perf_counter() - start)
+
+            async def schedule_unban():
+                if not duration:
+                    return
+                pending = {
+                    "user": str(user.id),
+                    "timestamp": end_time,
+                    "type": "ban",
+                }
+                await insert_doc("pending", pending)
+                self.unbans.add(end_time, pending["_id"], user.id)
+
+            case_num, unban, _ = await side_effects(
+                add_modlog(user, ctx.author, "ban", reason, duration=duration_delta),
+                schedule_unban(),
+                self.mod_action_embed(author=ctx.author, target=user,
+                                      desc=f"**Banned {user.mention}**" +
+                                           (f" **for:**\n```{reason}```" if reason else ""),
+                                      fields={"Duration": duration_str, "Unban": dynamic_str} if duration else None,
+                                      ),
+            )
+
+            summary = await get_doc(str(user.id), "mod_summary")
+            footer = case_footer(case_num, can_dm, summary)
+            if isinstance(unban, Exception):  # Not optional like the rest, nothing will ever lift the ban
+                footer += "\n⚠️ Unban not scheduled, they'll need unbanning by hand"
+            em.set_footer(text=footer)
+            await message.edit(embed=em)
+
+        await reason_modal(ctx, callback)
+
+    async def mass_targets(self, ctx: discord.ApplicationContext, users: str, joined_minutes: int):
+        """
+        Work out who a mass action applies to, either from a list of IDs/mentions or everyone who joined recently
+        Returns the targets and a list of (user id, reason) for anyone skipped
+        """
+        targets = {}
+        if users:
+            for user_id in re.findall(r"\d{15,20}", users):
+                user_id = int(user_id)
+                targets[user_id] = ctx.guild.get_member(user_id) or discord.Object(user_id)
+        if joined_minutes:
+            since = utc_now() - dt.timedelta(minutes=joined_minutes)
+            for member in ctx.guild.members:
+                if member.joined_at and member.joined_at > since:
+                    targets[member.id] = member
+
+        skipped = []
+        for user_id, target in list(targets.items()):
+            reason = None
+            if user_id == ctx.author.id:
+                reason = "That's you"
+            elif isinstance(target, discord.Member):
+                if target.bot:
+                    reason = "Bot"
+                elif target.top_role >= ctx.author.top_role:
+                    reason = "Higher or equal role"
+            if reason:
+                del targets[user_id]
+                skipped.append((user_id, reason))
+
+        return list(targets.values()), skipped
+
+    async def confirm_targets(self, interaction: discord.Interaction, ctx: discord.ApplicationContext, action: str,
+                              targets: list, skipped: list) -> bool:
+        """
+        Show who a mass action resolved to and wait for the mod to confirm it, so a typo in joined_minutes can't take
+        out half the server. Returns whether to go ahead
+        """
+        em = discord.Embed(color=RED, timestamp=utc_now())
+        if not targets:
+            em.title = f"Nobody to {action}"
+            em.description = f"{len(skipped)} skipped" if skipped else None
+            await interaction.followup.send(embed=em)
+            return False
+
+        em.title = f"⚠️ {action.title()} {len(targets)} users?"
+        em.description = "\n".join(f"<@{target.id}> ({target.id})" for target in targets[:MASS_ACTION_PREVIEW])
+        if len(targets) > MASS_ACTION_PREVIEW:
+            em.description += f"\n...and {len(targets) - MASS_ACTION_PREVIEW} more"
+        if skipped:
+            em.description += f"\n\n{len(skipped)} skipped"
+
+        view = Confirm(ctx.author)
+        message = await interaction.followup.send(embed=em, view=view, wait=True)
+        await view.wait()
+
+        if not view.confirmed:
+            em.title = f"Mass {action} cancelled"
+        await message.edit(embed=em, view=None)
+        return view.confirmed
+
+    async def mass_action(self, ctx: discord.ApplicationContext, targets: list, skipped: list, action, log_type: str,
+                          reason: str, duration: dt.timedelta = None):
+        """
+        Run action on every target through a small worker pool, then log everything in one go
+        action is a coroutine function taking the target
+        """
+        semaphore = asyncio.Semaphore(MASS_ACTION_CONCURRENCY)
+
+        async def run(target):
+            async with semaphore:
+                try:
+                    await action(target)
+                except discord.HTTPException as e:
+                    return target, e.text or str(e.status)
+                except Exception as e:  # Anything else shouldn't take the rest of the batch and its logging down
+                    print(f"Mass {log_type} failed for {target.id}:\n{traceback(e)}")
+                    return target, repr(e)
+                return target, None
+
+        results = await asyncio.gather(*(run(target) for target in targets))
+        done = [target for target, error in results if error is None]
+        failed = [(target.id, error) for target, error in results if error is not None]
+
+        # One insert for every mod log entry
+        cases = await next_case_numbers(len(done)) if done else []
+        now = utc_now()
+        errors = await insert_docs("mod_logs", [{
+            "case": case,
+            "user": str(target.id),
+            "mod": str(ctx.author.id),
+            "type": log_type,
+            "duration": duration.total_seconds() if duration else None,
+            "reason": reason,
+            "timestamp": now,
+        } for target, case in zip(done, cases)])
+        for error in errors.values():
+            print(f"Mass {log_type} mod log insert failed: {error}")
+        logged = [target for i, target in enumerate(done) if i not in errors]
+        # Buffered, so these go out as one bulk write too
+        await asyncio.gather(*(update_summary(str(target.id), log_type, now, buffered=True) for target in logged))
+
+        # One summary file rather than an embed per user
+        lines = [f"{log_type.title()} by {ctx.author} ({ctx.author.id}) at {now.isoformat()}", f"Reason: {reason}", ""]
+        lines += [f"{target.id} {getattr(target, 'name', '')} - case #{case}" +
+                  (f" - NOT LOGGED: {errors[i]}" if i in errors else "")
+                  for i, (target, case) in enumerate(zip(done, cases))]
+        lines += [f"{user_id} - FAILED: {error}" for user_id, error in failed]
+        lines += [f"{user_id} - skipped: {why}" for user_id, why in skipped]
+        file = discord.File(BytesIO("\n".join(lines).encode()), filename=f"mass_{log_type}.txt")
+
+        summary = f"**{len(done)}** succeeded, **{len(failed)}** failed, **{len(skipped)}** skipped"
+        if cases:
+            summary += f"\nCases #{cases[0]} - #{cases[-1]}"
+        if errors:
+            summary += f"\n⚠️ **{len(errors)}** couldn't be added to the mod logs, see the file"
+        return summary, file
+
+    @discord.slash_command()
+    @discord.default_permissions(ban_members=True)
+    @discord.option("users", str, description="User IDs or mentions to ban", required=False)
+    @discord.option("joined_minutes", int, description="Ban everyone who joined in the last N minutes", required=False)
+    async def massban(self, ctx: discord.ApplicationContext, users: str = None, joined_minutes: int = None):
+        """
+        Ban lots of users at once, e.g. during a raid
+        """
+        if not users and not joined_minutes:
+            await ctx.respond("Either `users` or `joined_minutes` must be given", ephemeral=True)
+            return
+        if joined_minutes and not 0 < joined_minutes <= MASS_ACTION_MAX_MINUTES:
+            await ctx.respond(f"`joined_minutes` must be between 1 and {MASS_ACTION_MAX_MINUTES}", ephemeral=True)
+            return
+
+        async def callback(interaction, reason):
+            await interaction.response.defer()
+
+            targets, skipped = await self.mass_targets(ctx, users, joined_minutes)
+            if not await self.confirm_targets(interaction, ctx, "ban", targets, skipped):
+                return
 
-            await self.mod_action_embed(author=ctx.author, target=user,
-                                        desc=f"**Banned {user.mention}**" +
-                                             (f" **for:**\n```{reason}```" if reason else ""),
-                                        fields={"Duration": duration_str, "Unban": dynamic_str} if duration else None,
-                                        )
+            async def ban(target):
+                await ctx.guild.ban(target, reason=reason, delete_message_days=0)
+
+            summary, file = await self.mass_action(ctx, targets, skipped, ban, "ban", reason)
+
+            em = discord.Embed(color=RED, timestamp=utc_now(), title="🔨 Mass ban", description=summary)
+            await interaction.followup.send(embed=em)
+
+            await self.mod_action_embed(author=ctx.author, title="🔨 Mass ban",
+                                        desc=summary + (f"\n**Reason:**\n```{reason}```" if reason else ""), file=file)
+
+        await reason_modal(ctx, callback)
+
+    @discord.slash_command()
+    @discord.default_permissions(moderate_members=True)
+    @discord.option("units", description="The unit the duration is in", choices=[
+        discord.OptionChoice(name="Minutes", value=60),
+        discord.OptionChoice(name="Hours", value=60 * 60),
+        discord.OptionChoice(name="Days", value=24 * 60 * 60),
+    ])
+    @discord.option("users", str, description="User IDs or mentions to mute", required=False)
+    @discord.option("joined_minutes", int, description="Mute everyone who joined in the last N minutes",
+                    required=False)
+    async def masstimeout(self, ctx: discord.ApplicationContext,
+                          raw_duration: discord.Option(int, "The duration of the mute", name="duration"), units: int,
+                          users: str = None, joined_minutes: int = None):
+        """
+        Timeout lots of users at once, e.g. during a raid
+        """
+        if not users and not joined_minutes:
+            await ctx.respond("Either `users` or `joined_minutes` must be given", ephemeral=True)
+            return
+        if joined_minutes and not 0 < joined_minutes <= MASS_ACTION_MAX_MINUTES:
+            await ctx.respond(f"`joined_minutes` must be between 1 and {MASS_ACTION_MAX_MINUTES}", ephemeral=True)
+            return
+
+        duration = dt.timedelta(seconds=raw_duration * units)
+        if raw_duration < 1 or duration > dt.timedelta(days=28):
+            await ctx.respond("The duration must be between 1 minute and 28 days", ephemeral=True)
+            return
+
+        async def callback(interaction, reason):
+            await interaction.response.defer()
+
+            targets, skipped = await self.mass_targets(ctx, users, joined_minutes)
+            # Only members can be timed out
+            skipped += [(target.id, "Not in the server") for target in targets
+                        if not isinstance(target, discord.Member)]
+            targets = [target for target in targets if isinstance(target, discord.Member)]
+            if not await self.confirm_targets(interaction, ctx, "timeout", targets, skipped):
+                return
+
+            async def timeout(member):
+                await member.timeout_for(duration, reason=reason)
+
+            summary, file = await self.mass_action(ctx, targets, skipped, timeout, "timeout", reason, duration)
+            summary += f"\n**Duration:** {format_time(duration)}"
+
+            em = discord.Embed(color=YELLOW, timestamp=utc_now(), title="🔇 Mass timeout", description=summary)
+            await interaction.followup.send(embed=em)
+
+            await self.mod_action_embed(author=ctx.author, title="🔇 Mass timeout",
+                                        desc=summary + (f"\n**Reason:**\n```{reason}```" if reason else ""), file=file)
 
         await reason_modal(ctx, callback)
 
@@ -464,74 +1188,205 @@ class Moderation(commands.Cog):
         """
         await ctx.defer()
 
-        entries = await find_docs("mod_logs", {"user": str(member.id)})
-        text = []
-        for entry in entries:
-            case_num = entry["case"]
-            log_type = entry["type"].title()
-            mod = entry["mod"]
-            reason = entry["reason"]
-            duration = dt.timedelta(seconds=entry["duration"]) if entry["duration"] else None
-            timestamp = discord.utils.format_dt(entry["timestamp"])
-
-            duration = f"**Duration:** {format_time(duration)}\n" if duration else ""  # Don't show if no duration
-
-            text.append(f"**Case #{case_num}: {log_type}**\n"
-                        f"**Reason:** {reason}\n"
-                        f"{duration}"
-                        f"**Timestamp:** {timestamp}\n"
-                        f"**Mod:** <@{mod}>")
-
-        em = discord.Embed(colour=RED, timestamp=utc_now(), description="")
-        em.set_author(name=member.display_name, icon_url=member.display_avatar.url)
+        count = await count_docs("mod_logs", {"user": str(member.id)})
 
-        # Go through the entries in reverse, to add as many entries as we can to the description
-        for entry in text[::-1]:
-            new = entry + "\n\n" + em.description
-            if len(new) < EMBED_DESC_LIMIT:
-                em.description = new
-            else:
-                break
+        pages = ModLogPages(member, count)
+        view = LazyPage(ctx, pages.embed, pages.max_page)
+        embed = view.set_embed_footer(await view.page(0))
 
-        em.title = f"Mod Logs: {len(entries)} Entries"
+        await ctx.respond(embed=embed, view=view if pages.max_page > 1 else None)
 
-        await ctx.respond(embed=em)
+    @discord.slash_command()
+    @discord.default_permissions(manage_messages=True)
+    @discord.option("search", str,
+                    description='Words to look for in reasons. Use "quotes" for phrases, -word to exclude')
+    @discord.option("mod", discord.User, description="Only search actions by this mod", required=False)
+    @discord.option("log_type", description="Only search one type of action", required=False,
+                    choices=[discord.OptionChoice(name=log_type.title(), value=log_type) for log_type in LOG_TYPES])
+    @discord.option("after", str, description="Only search from this date on (YYYY-MM-DD)", required=False)
+    @discord.option("before", str, description="Only search up to this date (YYYY-MM-DD)", required=False)
+    async def searchlogs(self, ctx: discord.ApplicationContext, search: str, mod: discord.User = None,
+                         log_type: str = None, after: str = None, before: str = None):
+        """
+        Search mod log reasons, best matches first
+        """
+        try:
+            query = modlog_query(mod=mod, log_type=log_type, after=after, before=before)
+        except ValueError:
+            await ctx.respond("Dates must be in the format YYYY-MM-DD", ephemeral=True)
+            return
+        query["$text"] = {"$search": search}
+
+        await ctx.defer()
+
+        # Ranking happens in the db off the text index, only the best few come back
+        score = {"$meta": "textScore"}
+        results, total = await asyncio.gather(
+            find_docs("mod_logs", query, projection={"score": score}, sort=[("score", score)], limit=SEARCH_LIMIT),
+            count_docs("mod_logs", query),
+        )
+
+        title = f"🔎 Mod log search: {total} results"
+        if not results:
+            em = discord.Embed(colour=RED, timestamp=utc_now(), title=title, description="No matches")
+            await ctx.respond(embed=em)
+            return
+
+        pages = [discord.Embed(colour=RED, timestamp=utc_now(), title=title,
+                               description="\n\n".join(entry_text(entry, show_user=True) for entry in chunk))
+                 for chunk in chunks(results, MODLOGS_PER_PAGE)]
+        footer = f"Showing the best {SEARCH_LIMIT}" if total > SEARCH_LIMIT else None
+
+        view = Page(ctx, pages, footer=footer)
+        await ctx.respond(embed=view.set_embed_footer(pages[0]), view=view if len(pages) > 1 else None)
+
+    def case_embed(self, case: dict, title: str):
+        em = discord.Embed(colour=RED, timestamp=utc_now(), title=title, description=case_description(case))
+        user = self.bot.get_user(int(case["user"]))
+        if user:
+            em.set_author(name=user.display_name, icon_url=user.display_avatar.url)
+        return em
+
+    @discord.slash_command(name="case")
+    @discord.default_permissions(manage_messages=True)
+    async def case(self, ctx: discord.ApplicationContext, case_number: str):
+        """
+        Look up a case by its case #
+        """
+        await ctx.defer()
+
+        cases = await find_cases(case_number)
+        if not cases:
+            em = discord.Embed(colour=RED, title=f"🔍 Case #{case_number} not found", timestamp=utc_now())
+            await ctx.respond(embed=em)
+            return
+
+        # More than one only happens with old colliding case IDs, show them all
+        await ctx.respond(embeds=[self.case_embed(case, f"📁 Case #{case['case']}") for case in cases])
 
     @discord.slash_command()
     @discord.default_permissions(manage_messages=True)
-    async def removecase(self, ctx: discord.ApplicationContext, member: discord.Member, case_number):
+    @discord.option("member", description="Only look at this member's cases, needed if an old case # is ambiguous",
+                    required=False)
+    async def removecase(self, ctx: discord.ApplicationContext, case_number: str, member: discord.User = None):
         """
         Remove a case by its case #
         """
-        if not re.fullmatch(r"[0-9]{4}", case_number):
-            raise commands.BadArgument
-
         await ctx.defer()
 
-        case = await find_docs("mod_logs", {"case": case_number, "user": str(member.id)}, 1)
+        cases = await find_cases(case_number, str(member.id) if member else None)
 
-        if case:
-            case = case[0]
-        else:
+        if not cases:
             em = discord.Embed(colour=RED, title=f"🔍 Case #{case_number} not found", timestamp=utc_now())
-            em.set_author(name=member.display_name, icon_url=member.display_avatar.url)
+            if member:
+                em.set_author(name=member.display_name, icon_url=member.display_avatar.url)
             await ctx.respond(embed=em)
             return
 
-        await del_doc(case["_id"], "mod_logs")
+        if len(cases) > 1:
+            em = discord.Embed(colour=RED, title=f"⚠️ Case #{case_number} matches more than one case",
+                               description="Old case IDs could be reused, give the member too so the right one is "
+                                           "removed", timestamp=utc_now())
+            await ctx.respond(embed=em)
+            return
 
-        log_type = case["type"]
-        reason = case["reason"]
-        timestamp = discord.utils.format_dt(case["timestamp"])
-        mod = case["mod"]
+        case = cases[0]
 
-        em = discord.Embed(colour=RED, timestamp=utc_now(), title=f"🗑️ Removed case #{case_number}")
-        em.set_author(name=member.display_name, icon_url=member.display_avatar.url)
-        em.description = f"**{log_type.title()}**\n" \
-                         f"**Reason:** {reason}\n" \
-                         f"**Timestamp:** {timestamp}\n" \
-                         f"**Mod:** <@{mod}>"
-        await ctx.respond(embed=em)
+        await asyncio.gather(del_doc(case["_id"], "mod_logs"), update_summary(case["user"], case["type"], amount=-1))
+
+        await ctx.respond(embed=self.case_embed(case, f"🗑️ Removed case #{case['case']}"))
+
+    @discord.slash_command()
+    @discord.default_permissions(manage_guild=True)
+    async def rebuildsummaries(self, ctx: discord.ApplicationContext):
+        """
+        Recount everyone's mod history summary from their mod logs
+        """
+        await ctx.defer()
+
+        pipeline = [{"$group": {"_id": {"user": "$user", "type": "$type"}, "count": {"$sum": 1},
+                                "last": {"$max": "$timestamp"}}}]
+        summaries = {}
+        for group in await aggregate("mod_logs", pipeline):
+            summary = summaries.setdefault(group["_id"]["user"], {"total": 0, "counts": {}, "last": {}})
+            summary["total"] += group["count"]
+            summary["counts"][group["_id"]["type"]] = group["count"]
+            summary["last"][group["_id"]["type"]] = group["last"]
+
+        # Anyone left over has no mod logs at all any more, so their summary goes
+        orphans = [doc["_id"] async for doc in iter_docs("mod_summary", {}, projection={"_id": 1})
+                   if doc["_id"] not in summaries]
+
+        # Still batched by the bulk writer, but waited on so every failure is known about
+        results = await asyncio.gather(
+            *(update_doc(user_id, "mod_summary", {"$set": summary}, upsert=True, buffered=True)
+              for user_id, summary in summaries.items()),
+            *(del_doc(user_id, "mod_summary", buffered=True) for user_id in orphans),
+            return_exceptions=True)
+        failed = [(user_id, result) for user_id, result in zip([*summaries, *orphans], results)
+                  if isinstance(result, Exception)]
+        for user_id, error in failed:
+            print(f"Failed to rebuild the mod summary for {user_id}: {error}")
+
+        text = f"Rebuilt mod history summaries for {len(summaries)} users, removed {len(orphans)} with no mod logs"
+        if failed:
+            text += f"\n⚠️ {len(failed)} failed, run this again to retry them"
+        await ctx.respond(text)
+
+    @discord.user_command(name="Mod summary")
+    @discord.default_permissions(manage_messages=True)
+    async def modsummary(self, ctx: discord.ApplicationContext, user: discord.User):
+        summary = await get_doc(str(user.id), "mod_summary") or {}
+
+        em = discord.Embed(colour=RED, timestamp=utc_now(), title="📋 Mod summary",
+                           description=f"{user.mention}\n**{summary.get('total', 0)}** mod log entries")
+        em.set_author(name=user.display_name, icon_url=user.display_avatar.url)
+        em.set_footer(text=f"User ID: {user.id}")
+
+        for log_type in LOG_TYPES:
+            count = summary.get("counts", {}).get(log_type, 0)
+            last = summary.get("last", {}).get(log_type)
+            if count > 0:
+                last = discord.utils.format_dt(last.replace(tzinfo=dt.timezone.utc), "R") if last else "unknown"
+                em.add_field(name=f"{log_type.title()}s", value=f"**{count}**, last {last}")
+
+        em.add_field(name="Account created", value=discord.utils.format_dt(user.created_at, "R"), inline=False)
+        if isinstance(user, discord.Member) and user.joined_at:
+            em.add_field(name="Joined", value=discord.utils.format_dt(user.joined_at, "R"), inline=False)
+
+        await ctx.respond(embed=em, ephemeral=True)
+
+    @discord.slash_command()
+    @discord.default_permissions(manage_guild=True)
+    async def migratecases(self, ctx: discord.ApplicationContext):
+        """
+        Give cases with old random case IDs a proper case number. The old ID still works for lookups
+        """
+        await ctx.defer()
+
+        # Oldest first so the new numbers are in order. Only the ids are pulled so this stays small
+        legacy = [(doc["_id"], doc["case"]) async for doc in
+                  iter_docs("mod_logs", {"case": {"$type": "string"}}, projection={"case": 1},
+                            sort=[("timestamp", 1)])]
+
+        if not legacy:
+            await ctx.respond("There are no cases to migrate")
+            return
+
+        numbers = await next_case_numbers(len(legacy))
+        # Still batched by the bulk writer, but waited on so every failure is known about
+        results = await asyncio.gather(*(
+            update_doc(_id, "mod_logs", {"$set": {"case": number, "legacy_case": old_case}}, buffered=True)
+            for (_id, old_case), number in zip(legacy, numbers)
+        ), return_exceptions=True)
+        failed = [(old_case, result) for (_, old_case), result in zip(legacy, results) if isinstance(result, Exception)]
+        for old_case, error in failed:
+            print(f"Failed to renumber case {old_case}: {error}")
+
+        text = f"Renumbered {len(legacy) - len(failed)} cases to #{numbers[0]} - #{numbers[-1]}"
+        if failed:
+            text += f"\n⚠️ {len(failed)} failed and still have their old ID, run this again to retry them"
+        await ctx.respond(text)
 
     @discord.slash_command()
     @discord.default_permissions(manage_messages=True)
@@ -572,32 +1427,112 @@ class Moderation(commands.Cog):
 
         await reason_modal(ctx, callback)
 
-    @tasks.loop(minutes=5)
-    async def unban_loop(self):
-        await self.bot.wait_until_ready()
-        guild = self.bot.get_guild(GUILD_ID)
+    @discord.slash_command()
+    @discord.default_permissions(manage_messages=True)
+    @discord.option("format", description="File format", parameter_name="fmt", default="csv", choices=[
+        discord.OptionChoice(name="CSV", value="csv"),
+        discord.OptionChoice(name="JSON lines", value="jsonl"),
+    ])
+    @discord.option("user", discord.User, description="Only export this user's logs", required=False)
+    @discord.option("mod", discord.User, description="Only export actions by this mod", required=False)
+    @discord.option("log_type", description="Only export one type of action", required=False,
+                    choices=[discord.OptionChoice(name=log_type.title(), value=log_type) for log_type in LOG_TYPES])
+    @discord.option("after", str, description="Only export from this date on (YYYY-MM-DD)", required=False)
+    @discord.option("before", str, description="Only export up to this date (YYYY-MM-DD)", required=False)
+    async def exportlogs(self, ctx: discord.ApplicationContext, fmt: str, user: discord.User = None,
+                         mod: discord.User = None, log_type: str = None, after: str = None, before: str = None):
+        """
+        Export mod logs to a file, e.g. for an appeal
+        """
+        try:
+            query = modlog_query(user, mod, log_type, after, before)
+        except ValueError:
+            await ctx.respond("Dates must be in the format YYYY-MM-DD", ephemeral=True)
+            return
 
-        # Get all pending bans
-        pending_bans = await find_docs("pending", {"type": "ban"})
+        await ctx.defer()
 
-        for ban in pending_bans:
-            _id = ban["_id"]
-            user_id = int(ban["user"])
-            timestamp: dt.datetime = ban["timestamp"]
-            timestamp = timestamp.replace(tzinfo=dt.timezone.utc)
+        if fmt == "csv":
+            export = TranscriptWriter("csv", modlog_csv, header=",".join(EXPORT_FIELDS) + "\n", compress=True)
+        else:
+            export = TranscriptWriter("jsonl", modlog_jsonl, compress=True)
+
+        # Streamed off a cursor a batch at a time, only one batch is ever held in memory
+        batch = []
+        async for entry in iter_docs("mod_logs", query, projection={"_id": 0}, sort=[("timestamp", 1)],
+                                     batch_size=EXPORT_BATCH):
+            batch.append(entry)
+            if len(batch) >= EXPORT_BATCH:
+                await export.add(batch)
+                batch = []
+        await export.add(batch)
+
+        name = f"mod_logs_{user.id}" if user else "mod_logs"
+        em = discord.Embed(colour=RED, timestamp=utc_now(), title=f"📦 Exported {export.count} mod log entries")
+        try:
+            await ctx.respond(embed=em, file=await export.to_file(name))
+        except discord.HTTPException as e:
+            if e.status != 413:
+                raise
+            await ctx.respond("The export is too big to upload, try narrowing it down with the filters")
 
-            if timestamp < utc_now():
-                try:
-                    await guild.unban(discord.Object(user_id), reason="Temp ban")
-                except discord.NotFound:
-                    # If the user is not banned, just delete the entry
-                    # Could have been manually unbanned
-                    pass
+    @discord.slash_command()
+    @discord.default_permissions(manage_messages=True)
+    @discord.option("stat", description="What to count", choices=[
+        discord.OptionChoice(name="Actions per week", value="week"),
+        discord.OptionChoice(name="Actions per mod", value="mod"),
+        discord.OptionChoice(name="Most actioned users", value="user"),
+    ])
+    @discord.option("log_type", description="Only count one type of action", required=False,
+                    choices=[discord.OptionChoice(name=log_type.title(), value=log_type) for log_type in LOG_TYPES])
+    @discord.option("days", int, description="Only count the last few days (default: all time)", required=False)
+    async def modstats(self, ctx: discord.ApplicationContext, stat: str, log_type: str = None, days: int = None):
+        """
+        Moderation statistics
+        """
+        await ctx.defer()
 
-                await del_doc(_id, "pending")
+        match = {}
+        if log_type:
+            match["type"] = log_type
+        if days:
+            # Round to the hour so repeat runs hit the cache
+            since = utc_now().replace(minute=0, second=0, microsecond=0) - dt.timedelta(days=days)
+            match["timestamp"] = {"$gte": since}
+
+        # All the counting happens in the db, we only get the top few groups back
+        pipeline = [{"$match": match}] if match else []
+        if stat == "week":
+            title = "Actions per week"
+            pipeline += [
+                {"$group": {"_id": {"year": {"$isoWeekYear": "$timestamp"}, "week": {"$isoWeek": "$timestamp"}},
+                            "count": {"$sum": 1}}},
+                {"$sort": {"_id.year": -1, "_id.week": -1}},
+                {"$limit": 12},
+            ]
+        else:
+            title = "Actions per mod" if stat == "mod" else "Most actioned users"
+            pipeline += [
+                {"$group": {"_id": f"${stat}", "count": {"$sum": 1}, "last": {"$max": "$timestamp"}}},
+                {"$sort": {"count": -1}},
+                {"$limit": 15},
+            ]
+
+        results = await aggregate("mod_logs", pipeline, ttl=MODSTATS_TTL)
+
+        lines = []
+        for result in results:
+            if stat == "week":
+                lines.append(f"**{result['_id']['year']} week {result['_id']['week']}:** {result['count']}")
+            else:
+                lines.append(f"<@{result['_id']}>: **{result['count']}** "
+                             f"(last {discord.utils.format_dt(result['last'].replace(tzinfo=dt.timezone.utc), 'R')})")
 
-        if not pending_bans:  # Don't bother running the loop if there are no bans
-            self.unban_loop.stop()
+        em = discord.Embed(colour=RED, timestamp=utc_now(), title=f"📊 {title}",
+                           description="\n".join(lines) if lines else "Nothing to count")
+        em.set_footer(text=f"{log_type.title() + 's' if log_type else 'All actions'}, "
+                           f"{f'last {days} days' if days else 'all time'}")
+        await ctx.respond(embed=em)
 
     @discord.slash_command()
     @discord.default_permissions(ban_members=True)
@@ -2,7 +2,10 @@ from discord.ext import commands
 import discord
 import yaml
 from config import MAIN
-from utils.db_utils import set_prop, get_prop
+from utils.db_utils import set_prop, get_prop, cache_policy
+from utils.events import MemberUpdate, subscribe_member_update, unsubscribe_member_update
+
+cache_policy("roles", ttl=5 * 60)
 
 
 class View(discord.ui.View):
@@ -75,6 +78,11 @@ class Roles(commands.Cog):
         with open("roles.yaml") as fd:
             self.role_config = yaml.full_load(fd)
 
+        subscribe_member_update("Roles", self.member_updated)
+
+    def cog_unload(self):
+        unsubscribe_member_update("Roles")
+
     @discord.message_command(name="Attach role menu")
     @discord.default_permissions(manage_messages=True)
     async def attach_roles(self, ctx: discord.ApplicationContext, message: discord.Message):
@@ -91,20 +99,14 @@ class Roles(commands.Cog):
     async def on_ready(self):
         self.bot.add_view(RoleMenu(self.role_config))
 
-    @commands.Cog.listener()
-    async def on_member_update(self, old_member: discord.Member, new_member: discord.Member):
+    async def member_updated(self, update: MemberUpdate):
         """
         When a role is added or removed, look up what category it is in and determine whether to add a header role
         """
-        removed_roles = [role for role in old_member.roles if role not in new_member.roles]
-        added_roles = [role for role in new_member.roles if role not in old_member.roles]
-
-        for role in added_roles:
-            await self.process_roles(new_member, role)
-        for role in removed_roles:
-            await self.process_roles(new_member, role)
+        for role_id in update.added | update.removed:
+            await self.process_roles(update.new, role_id)
 
-    async def process_roles(self, member: discord.Member, changed_role: discord.Role):
+    async def process_roles(self, member: discord.Member, changed_role_id: int):
         for detail in self.role_config.values():
             divider_id = detail.get("divider")
             if not divider_id:
@@ -112,25 +114,20 @@ class Roles(commands.Cog):
 
             roles = [x["id"] for x in detail.get("roles", {}).values()]
 
-            if changed_role.id in roles:
+            if changed_role_id in roles:
                 # We have found the category this role belongs to
 
                 # Determine if we need to add or remove the divider
 
-                has_roles_in_category = False
-
-                for role_id in roles:
-                    role = member.guild.get_role(role_id)
-                    if role in member.roles:
-                        has_roles_in_category = True
-                        break
+                member_roles = {role.id for role in member.roles}
+                has_roles_in_category = any(role_id in member_roles for role_id in roles)
 
                 # Apply the changes
 
                 divider = member.guild.get_role(divider_id)
-                if has_roles_in_category and divider not in member.roles:
+                if has_roles_in_category and divider_id not in member_roles:
                     await member.add_roles(divider, reason="Divider role.")
-                elif not has_roles_in_category and divider in member.roles:
+                elif not has_roles_in_category and divider_id in member_roles:
                     await member.remove_roles(divider, reason="Divider role.")
 
                 # Don't process other categories since we have already matched one
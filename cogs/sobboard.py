@@ -1,13 +1,15 @@
 import discord
 from discord.ext import commands
 from config import GUILD_ID, SOBBOARD_ID, MAIN
-from utils.db_utils import find_docs, insert_doc
+from utils.db_utils import find_doc, insert_doc, declare_index
 
 SOB = "😭"
 SOB_THRESHOLD = 5
 
 SOB_CONTENT = "😭 {count} | Message in {channel} by {author} had us sobbing"
 
+declare_index("starboard", [("channel", 1), ("message", 1)])
+
 
 def message_to_embed(message: discord.Message):
     em = discord.Embed(colour=MAIN, timestamp=message.created_at, description=message.content)
@@ -62,9 +64,8 @@ class Sobboard(commands.Cog):
         if not stars:  # Also shouldn't happen
             return
 
-        entry = await find_docs("starboard",
-                                {"channel": str(payload.channel_id), "message": str(payload.message_id)}, 1)
-        entry = entry[0] if entry else None
+        entry = await find_doc("starboard", {"channel": str(payload.channel_id), "message": str(payload.message_id)},
+                               projection={"_id": 0, "destination": 1})
 
         if entry:
             destination = entry["destination"]
@@ -2,7 +2,8 @@ import discord
 from discord.ext import commands
 from config import VERIFY_WORDS, UNVERIFIED_ID, GUILD_ID, VERIFY_ID
 from random import choice
-from utils.db_utils import set_prop, get_prop
+from utils.db_utils import set_prop, get_prop, cache_policy
+from utils.events import MemberUpdate, subscribe_member_update, unsubscribe_member_update
 import asyncio
 import datetime as dt
 
@@ -10,6 +11,9 @@ import datetime as dt
 DB_COLL = "verification"
 VERIFY_DURATION = dt.timedelta(minutes=10)
 
+# Every join looks this up (sometimes several times), so keep it in memory
+cache_policy(DB_COLL, ttl=15 * 60)
+
 """
 Verification process is like this:
 
@@ -98,6 +102,11 @@ class Verification(commands.Cog):
         self.bot = bot
         self.unverified_role = None
 
+        subscribe_member_update("Verification", self.member_updated)
+
+    def cog_unload(self):
+        unsubscribe_member_update("Verification")
+
 
     @commands.Cog.listener()
     async def on_ready(self):
@@ -128,18 +137,18 @@ class Verification(commands.Cog):
             await member.add_roles(self.unverified_role)
 
 
-    @commands.Cog.listener()
-    async def on_member_update(self, old: discord.Member, new: discord.Member):
-        member = new
+    async def member_updated(self, update: MemberUpdate):
+        member = update.new
         if member.bot: return
 
         # Verification role removed
-        if self.unverified_role in old.roles and self.unverified_role not in new.roles:
+        if UNVERIFIED_ID in update.removed:
             # User has been verified so mark in db
-            await set_prop(member.id, DB_COLL, "verified", True)
+            # Fire and forget - the cache is updated straight away and this gets batched up with any other verifications
+            await set_prop(member.id, DB_COLL, "verified", True, buffered=True, wait=False)
 
         # Role added
-        elif self.unverified_role in new.roles and self.unverified_role not in old.roles:
+        elif UNVERIFIED_ID in update.added:
             # If the user has already been verified just remove the role again
             if await is_verified(member):
                 await member.remove_roles(self.unverified_role, reason="User already verified")
@@ -0,0 +1,735 @@
+"""
+Storage backends for db_utils
+
+Everything in db_utils goes through one of these, picked with the DB_BACKEND env var:
+    mongo  - (default) A real mongodb server via motor, using MONGO_URI
+             The connection pool can be tuned with MONGO_MAX_POOL, MONGO_MIN_POOL, MONGO_CONNECT_TIMEOUT_MS,
+             MONGO_SERVER_TIMEOUT_MS and MONGO_COMPRESSORS (e.g. "zstd,zlib")
+    memory - Plain dicts in this process. Nothing is saved, handy for tests and benchmarks
+    sqlite - The memory backend, but every write is also saved to an sqlite file at SQLITE_PATH
+
+Writes are passed around as tuples of ("insert", doc), ("update", filter, update, upsert) or ("delete", filter)
+"""
+import asyncio
+import datetime as dt
+import json
+import re
+from copy import deepcopy
+from os import getenv
+
+from bson import ObjectId
+
+
+class Backend:
+    """The interface every backend implements. Queries, projections and updates use mongo's syntax"""
+
+    async def find_one(self, collection: str, query: dict, projection: dict = None, sort: list = None):
+        raise NotImplementedError
+
+    def find(self, collection: str, query: dict, projection: dict = None, sort: list = None, limit: int = 0,
+             batch_size: int = None):
+        """Returns an async iterator of docs"""
+        raise NotImplementedError
+
+    async def count(self, collection: str, query: dict) -> int:
+        raise NotImplementedError
+
+    def aggregate(self, collection: str, pipeline: list):
+        """Returns an async iterator of results"""
+        raise NotImplementedError
+
+    async def insert_one(self, collection: str, doc: dict):
+        raise NotImplementedError
+
+    async def update_one(self, collection: str, query: dict, update: dict, upsert: bool = False):
+        raise NotImplementedError
+
+    async def find_one_and_update(self, collection: str, query: dict, update: dict, upsert: bool = False,
+                                  projection: dict = None):
+        """Atomically update a doc and return it as it is after the update"""
+        raise NotImplementedError
+
+    async def delete_one(self, collection: str, query: dict):
+        raise NotImplementedError
+
+    async def bulk_write(self, collection: str, ops: list) -> dict:
+        """Apply the writes unordered. Returns {index: exception} for any that failed"""
+        raise NotImplementedError
+
+    async def create_index(self, collection: str, keys: list, **options):
+        raise NotImplementedError
+
+    async def warm_up(self):
+        """Connect and make sure the backend is usable, so the first real query doesn't pay for it"""
+        pass
+
+    async def close(self):
+        pass
+
+
+# MotorClient option -> env var
+_MONGO_OPTIONS = {
+    "maxPoolSize": ("MONGO_MAX_POOL", int),
+    "minPoolSize": ("MONGO_MIN_POOL", int),
+    "connectTimeoutMS": ("MONGO_CONNECT_TIMEOUT_MS", int),
+    "serverSelectionTimeoutMS": ("MONGO_SERVER_TIMEOUT_MS", int),
+    "compressors": ("MONGO_COMPRESSORS", str),
+}
+
+
+class MotorBackend(Backend):
+    """The client is only created on first use (or warm_up), so importing this never touches the network"""
+
+    def __init__(self, uri: str):
+        self.uri = uri
+        self.options = {}
+        for option, (env, cast) in _MONGO_OPTIONS.items():
+            value = getenv(env)
+            if value:
+                self.options[option] = cast(value)
+
+        self.client = None
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            from motor import motor_asyncio
+
+            self.client = motor_asyncio.AsyncIOMotorClient(self.uri, **self.options)
+            self._db = self.client.qcbot
+        return self._db
+
+    async def warm_up(self):
+        # Ping over several connections at once so the pool is filled up to minPoolSize, not just one connection
+        connections = max(1, self.options.get("minPoolSize", 1))
+        await asyncio.gather(*(self.db.command("ping") for _ in range(connections)))
+
+    async def find_one(self, collection, query, projection=None, sort=None):
+        return await self.db[collection].find_one(query, projection, sort=sort)
+
+    async def find(self, collection, query, projection=None, sort=None, limit=0, batch_size=None):
+        cursor = self.db[collection].find(query, projection, sort=sort, limit=limit)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+
+        async for doc in cursor:
+            yield doc
+
+    async def count(self, collection, query):
+        return await self.db[collection].count_documents(query)
+
+    async def aggregate(self, collection, pipeline):
+        async for doc in self.db[collection].aggregate(pipeline):
+            yield doc
+
+    async def insert_one(self, collection, doc):
+        await self.db[collection].insert_one(doc)
+
+    async def update_one(self, collection, query, update, upsert=False):
+        await self.db[collection].update_one(query, update, upsert=upsert)
+
+    async def find_one_and_update(self, collection, query, update, upsert=False, projection=None):
+        from pymongo import ReturnDocument
+
+        return await self.db[collection].find_one_and_update(query, update, projection, upsert=upsert,
+                                                             return_document=ReturnDocument.AFTER)
+
+    async def delete_one(self, collection, query):
+        await self.db[collection].delete_one(query)
+
+    async def bulk_write(self, collection, ops):
+        from pymongo import InsertOne, UpdateOne, DeleteOne
+        from pymongo.errors import BulkWriteError
+
+        types = {"insert": InsertOne, "update": UpdateOne, "delete": DeleteOne}
+        try:
+            await self.db[collection].bulk_write([types[kind](*args) for kind, *args in ops], ordered=False)
+        except BulkWriteError as e:
+            # Unordered, so everything else still went through
+            return {error["index"]: e for error in e.details["writeErrors"]}
+        return {}
+
+    async def create_index(self, collection, keys, **options):
+        await self.db[collection].create_index(keys, **options)
+
+    async def close(self):
+        if self.client:
+            self.client.close()
+
+
+class DuplicateKeyError(Exception):
+    pass
+
+
+def _naive_utc(value):
+    """Mongo stores datetimes as naive UTC, do the same so comparisons behave identically"""
+    if isinstance(value, dt.datetime) and value.tzinfo:
+        return value.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    if isinstance(value, dict):
+        return {k: _naive_utc(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_naive_utc(v) for v in value]
+    return value
+
+
+_MISSING = object()
+
+
+def _get_field(doc: dict, path: str):
+    for part in path.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return _MISSING
+        doc = doc[part]
+    return doc
+
+
+def _set_field(doc: dict, path: str, value):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[last] = value
+
+
+def _unset_field(doc: dict, path: str):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(last, None)
+
+
+def _compare(a, b):
+    """Compare two values, returning None if they can't be compared (mongo would compare by type first)"""
+    try:
+        return (a > b) - (a < b)
+    except TypeError:
+        return None
+
+
+def _match_value(value, condition) -> bool:
+    if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+        return all(_match_operator(value, op, arg) for op, arg in condition.items())
+
+    # Plain equality, which also matches an element of an array
+    if isinstance(value, list) and not isinstance(condition, list):
+        return condition in value
+    return (None if value is _MISSING else value) == condition
+
+
+def _match_operator(value, op: str, arg) -> bool:
+    if op == "$eq":
+        return _match_value(value, arg)
+    if op == "$ne":
+        return not _match_value(value, arg)
+    if op == "$in":
+        return any(_match_value(value, x) for x in arg)
+    if op == "$nin":
+        return not any(_match_value(value, x) for x in arg)
+    if op == "$exists":
+        return (value is not _MISSING) == bool(arg)
+    if op == "$regex":
+        return isinstance(value, str) and re.search(arg, value) is not None
+    if op in ("$gt", "$gte", "$lt", "$lte"):
+        if value is _MISSING:
+            return False
+        result = _compare(value, arg)
+        if result is None:
+            return False
+        return {"$gt": result > 0, "$gte": result >= 0, "$lt": result < 0, "$lte": result <= 0}[op]
+    if op == "$type":
+        if arg == "number":
+            return type(value) in (int, float)
+        types = {"int": int, "long": int, "string": str, "date": dt.datetime, "double": float, "bool": bool,
+                 "object": dict}
+        return type(value) is types[arg]
+    raise NotImplementedError(f"Query operator {op} isn't supported by this backend")
+
+
+def match(doc: dict, query: dict) -> bool:
+    """Check if a doc matches a mongo style query"""
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(match(doc, q) for q in condition):
+                return False
+        elif key == "$or":
+            if not any(match(doc, q) for q in condition):
+                return False
+        elif key.startswith("$"):
+            raise NotImplementedError(f"Query operator {key} isn't supported by this backend")
+        elif not _match_value(_get_field(doc, key), condition):
+            return False
+    return True
+
+
+def project(doc: dict, projection: dict):
+    if not projection:
+        return doc
+
+    include_id = projection.get("_id", 1)
+    fields = {k: v for k, v in projection.items() if k != "_id"}
+
+    if any(fields.values()):  # Inclusion
+        result = {}
+        for path in fields:
+            value = _get_field(doc, path)
+            if value is not _MISSING:
+                _set_field(result, path, value)
+    else:  # Exclusion
+        result = deepcopy(doc)
+        for path in fields:
+            _unset_field(result, path)
+
+    if include_id and "_id" in doc:
+        result["_id"] = doc["_id"]
+    else:
+        result.pop("_id", None)
+    return result
+
+
+def _words(text: str) -> list:
+    return re.findall(r"\w+", text.lower())
+
+
+def text_score(doc: dict, fields: list, search: str) -> float:
+    """
+    Rough version of mongo's $text search over fields, without stemming or stop words
+    Any of the words can match, but "quoted phrases" must all appear and -words must not
+    Returns 0 if it doesn't match, otherwise the higher the better
+    """
+    text = " ".join(value for value in (_get_field(doc, field) for field in fields) if isinstance(value, str))
+    words = _words(text)
+    lowered = " ".join(words)
+
+    phrases = re.findall(r'"([^"]*)"', search)
+    rest = re.sub(r'"[^"]*"', " ", search).split()
+    negated = [word[1:].lower() for word in rest if word.startswith("-")]
+    terms = [term for word in rest if not word.startswith("-") for term in _words(word)]
+
+    if any(negative in words for negative in negated):
+        return 0
+    if any(" ".join(_words(phrase)) not in lowered for phrase in phrases):
+        return 0
+
+    hits = sum(words.count(term) for term in terms) + len(phrases)
+    if not hits or not words:
+        return 0
+    return hits / len(words) + hits  # More matches first, shorter text breaks ties
+
+
+def _sort_key(value):
+    # None/missing sort first like in mongo, then group by type so mixed types don't explode
+    if value is _MISSING or value is None:
+        return 0, 0
+    if isinstance(value, (int, float)):
+        return 1, value
+    if isinstance(value, str):
+        return 2, value
+    return 3, value
+
+
+def sort_docs(docs: list, sort: list, scores: dict = None):
+    # Stable sort, so sorting by each key from last to first gives a multi key sort
+    for field, direction in reversed(sort):
+        if isinstance(direction, dict):  # {"$meta": "textScore"}, best match first
+            docs.sort(key=lambda doc: scores[doc["_id"]], reverse=True)
+        else:
+            docs.sort(key=lambda doc: _sort_key(_get_field(doc, field)), reverse=direction < 0)
+    return docs
+
+
+def evaluate(expression, doc: dict):
+    """Evaluate an aggregation expression like "$timestamp" or {"$isoWeek": "$timestamp"} against a doc"""
+    if isinstance(expression, str) and expression.startswith("$"):
+        value = _get_field(doc, expression[1:])
+        return None if value is _MISSING else value
+
+    if isinstance(expression, dict):
+        if len(expression) == 1 and next(iter(expression)).startswith("$"):
+            op, arg = next(iter(expression.items()))
+            value = evaluate(arg, doc)
+            if not isinstance(value, dt.datetime):
+                raise NotImplementedError(f"Expression {op} isn't supported by this backend")
+
+            if op == "$isoWeek":
+                return value.isocalendar()[1]
+            if op == "$isoWeekYear":
+                return value.isocalendar()[0]
+            if op == "$year":
+                return value.year
+            if op == "$month":
+                return value.month
+            if op == "$dayOfMonth":
+                return value.day
+            raise NotImplementedError(f"Expression {op} isn't supported by this backend")
+
+        return {key: evaluate(value, doc) for key, value in expression.items()}
+
+    return expression
+
+
+def _group(docs: list, spec: dict) -> list:
+    groups = {}  # repr of the group _id -> result doc
+    for doc in docs:
+        _id = evaluate(spec["_id"], doc)
+        result = groups.setdefault(repr(_id), {"_id": _id})
+
+        for field, accumulator in spec.items():
+            if field == "_id":
+                continue
+            (op, expression), = accumulator.items()
+            value = evaluate(expression, doc)
+
+            if op == "$sum":
+                result[field] = result.get(field, 0) + (value if isinstance(value, (int, float)) else 0)
+            elif op in ("$max", "$min"):
+                current = result.get(field)
+                if current is None or (value is not None and _compare(value, current) == (1 if op == "$max" else -1)):
+                    result[field] = value
+            elif op == "$first":
+                result.setdefault(field, value)
+            elif op == "$last":
+                result[field] = value
+            else:
+                raise NotImplementedError(f"Accumulator {op} isn't supported by this backend")
+
+    return list(groups.values())
+
+
+def run_pipeline(docs: list, pipeline: list) -> list:
+    """A subset of mongo's aggregation - $match, $group, $sort, $skip and $limit"""
+    for stage in pipeline:
+        (op, arg), = stage.items()
+
+        if op == "$match":
+            arg = _naive_utc(arg)
+            docs = [doc for doc in docs if match(doc, arg)]
+        elif op == "$group":
+            docs = _group(docs, arg)
+        elif op == "$sort":
+            docs = sort_docs(docs, list(arg.items()))
+        elif op == "$skip":
+            docs = docs[arg:]
+        elif op == "$limit":
+            docs = docs[:arg]
+        else:
+            raise NotImplementedError(f"Pipeline stage {op} isn't supported by this backend")
+    return docs
+
+
+def apply_update(doc: dict, update: dict, inserting: bool = False):
+    for op, fields in update.items():
+        for path, value in fields.items():
+            current = _get_field(doc, path)
+
+            if op == "$set":
+                _set_field(doc, path, deepcopy(value))
+            elif op == "$unset":
+                _unset_field(doc, path)
+            elif op == "$inc":
+                _set_field(doc, path, (0 if current is _MISSING else current) + value)
+            elif op == "$max":
+                if current is _MISSING or _compare(value, current) == 1:
+                    _set_field(doc, path, value)
+            elif op == "$min":
+                if current is _MISSING or _compare(value, current) == -1:
+                    _set_field(doc, path, value)
+            elif op == "$setOnInsert":
+                if inserting:
+                    _set_field(doc, path, deepcopy(value))
+            else:
+                raise NotImplementedError(f"Update operator {op} isn't supported by this backend")
+
+
+def _upsert_base(query: dict) -> dict:
+    """The doc an upsert starts from - just the equality parts of the query"""
+    doc = {}
+    for key, condition in query.items():
+        if key.startswith("$"):
+            continue
+        if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+            if "$eq" in condition:
+                _set_field(doc, key, deepcopy(condition["$eq"]))
+        else:
+            _set_field(doc, key, deepcopy(condition))
+    return doc
+
+
+class MemoryBackend(Backend):
+    """Keeps every collection in a dict of _id -> doc. Queries are full scans, which is fine at this scale"""
+
+    def __init__(self):
+        self.collections = {}  # collection -> {_id: doc}
+        self.unique = {}  # collection -> [(fields, partial filter)]
+        self.text = {}  # collection -> fields in its text index
+
+    def _coll(self, collection: str) -> dict:
+        return self.collections.setdefault(collection, {})
+
+    def _scan(self, collection: str, query: dict):
+        query = _naive_utc(query)
+        search = query.pop("$text", None)
+
+        docs = [doc for doc in self._coll(collection).values() if match(doc, query)]
+        if search:
+            scores = self._text_scores(collection, docs, search)
+            docs = [doc for doc in docs if scores[doc["_id"]]]
+        return docs
+
+    def _text_scores(self, collection: str, docs: list, search: dict) -> dict:
+        if collection not in self.text:
+            raise ValueError(f"$text queries need a text index, {collection} doesn't have one")
+        return {doc["_id"]: text_score(doc, self.text[collection], search["$search"]) for doc in docs}
+
+    def _check_unique(self, collection: str, doc: dict):
+        for fields, partial in self.unique.get(collection, []):
+            if partial and not match(doc, partial):
+                continue
+
+            key = [_get_field(doc, field) for field in fields]
+            for other in self._coll(collection).values():
+                if other["_id"] == doc["_id"] or (partial and not match(other, partial)):
+                    continue
+                if [_get_field(other, field) for field in fields] == key:
+                    raise DuplicateKeyError(f"Duplicate key for {collection} {fields}: {key}")
+
+    def _changed(self, collection: str, _id, doc):
+        """Called after every write with the new doc, or None if it was deleted"""
+        pass
+
+    async def find_one(self, collection, query, projection=None, sort=None):
+        async for doc in self.find(collection, query, projection, sort, limit=1):
+            return doc
+        return None
+
+    async def find(self, collection, query, projection=None, sort=None, limit=0, batch_size=None):
+        docs = self._scan(collection, query)
+        scores = self._text_scores(collection, docs, query["$text"]) if "$text" in query else {}
+
+        # {"$meta": "textScore"} fields are filled in after projecting, they don't make it an inclusion projection
+        meta = [field for field, value in (projection or {}).items() if isinstance(value, dict)]
+        if meta:
+            projection = {field: value for field, value in projection.items() if field not in meta}
+
+        if sort:
+            sort_docs(docs, sort, scores)
+        if limit:
+            docs = docs[:limit]
+
+        for doc in docs:
+            result = project(deepcopy(doc), projection)
+            for field in meta:
+                result[field] = scores[doc["_id"]]
+            yield result
+
+    async def count(self, collection, query):
+        return len(self._scan(collection, query))
+
+    async def aggregate(self, collection, pipeline):
+        docs = [deepcopy(doc) for doc in self._coll(collection).values()]
+        for doc in run_pipeline(docs, pipeline):
+            yield doc
+
+    def _insert_one(self, collection, doc):
+        doc.setdefault("_id", ObjectId())  # Like pymongo, the caller's doc gets the _id
+        stored = _naive_utc(deepcopy(doc))
+
+        if stored["_id"] in self._coll(collection):
+            raise DuplicateKeyError(f"Duplicate _id for {collection}: {stored['_id']}")
+        self._check_unique(collection, stored)
+
+        self._coll(collection)[stored["_id"]] = stored
+        self._changed(collection, stored["_id"], stored)
+
+    def _update_one(self, collection, query, update, upsert=False):
+        update = _naive_utc(update)
+        found = self._scan(collection, query)
+
+        if found:
+            doc = deepcopy(found[0])
+            apply_update(doc, update)
+        elif upsert:
+            doc = _upsert_base(_naive_utc(query))
+            apply_update(doc, update, inserting=True)
+            doc.setdefault("_id", ObjectId())
+        else:
+            return None
+
+        self._check_unique(collection, doc)
+        self._coll(collection)[doc["_id"]] = doc
+        self._changed(collection, doc["_id"], doc)
+        return doc
+
+    def _delete_one(self, collection, query):
+        found = self._scan(collection, query)
+        if found:
+            _id = found[0]["_id"]
+            del self._coll(collection)[_id]
+            self._changed(collection, _id, None)
+
+    async def insert_one(self, collection, doc):
+        self._insert_one(collection, doc)
+
+    async def update_one(self, collection, query, update, upsert=False):
+        self._update_one(collection, query, update, upsert)
+
+    async def find_one_and_update(self, collection, query, update, upsert=False, projection=None):
+        # There's no await between the read and the write, so this is atomic
+        doc = self._update_one(collection, query, update, upsert)
+        return project(deepcopy(doc), projection) if doc else None
+
+    async def delete_one(self, collection, query):
+        self._delete_one(collection, query)
+
+    async def bulk_write(self, collection, ops):
+        writes = {"insert": self._insert_one, "update": self._update_one, "delete": self._delete_one}
+
+        errors = {}
+        for i, (kind, *args) in enumerate(ops):
+            try:
+                writes[kind](collection, *args)
+            except Exception as e:
+                errors[i] = e
+        return errors
+
+    async def create_index(self, collection, keys, **options):
+        # Only unique and text indexes change behaviour, everything else is a full scan anyway
+        text = [field for field, kind in keys if kind == "text"]
+        if text:
+            self.text[collection] = text
+
+        if options.get("unique"):
+            fields = [field for field, _ in keys]
+            entry = (fields, options.get("partialFilterExpression"))
+            if entry not in self.unique.setdefault(collection, []):
+                self.unique[collection].append(entry)
+
+
+def _encode(value):
+    """JSON encoder for the types mongo docs contain"""
+    if isinstance(value, dt.datetime):
+        return {"$date": value.isoformat()}
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    raise TypeError(f"Can't store {type(value).__name__}")
+
+
+def _decode(obj: dict):
+    if len(obj) == 1:
+        if "$date" in obj:
+            return dt.datetime.fromisoformat(obj["$date"])
+        if "$oid" in obj:
+            return ObjectId(obj["$oid"])
+    return obj
+
+
+class SQLiteBackend(MemoryBackend):
+    """
+    The memory backend with every write persisted to sqlite
+    Everything is loaded into memory on first use, so reads never touch the disk
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.conn = None
+        self._pending = []  # Writes waiting to be saved
+
+    async def _ready(self):
+        if self.conn:
+            return
+
+        import aiosqlite
+
+        self.conn = await aiosqlite.connect(self.path)
+        await self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS docs (collection TEXT, id TEXT, doc TEXT, PRIMARY KEY (collection, id))"
+        )
+        async with self.conn.execute("SELECT collection, doc FROM docs") as cursor:
+            async for collection, doc in cursor:
+                doc = json.loads(doc, object_hook=_decode)
+                self._coll(collection)[doc["_id"]] = doc
+
+    def _changed(self, collection, _id, doc):
+        key = json.dumps(_id, default=_encode)
+        self._pending.append((collection, key, json.dumps(doc, default=_encode) if doc is not None else None))
+
+    async def _save(self):
+        pending, self._pending = self._pending, []
+        for collection, key, doc in pending:
+            if doc is None:
+                await self.conn.execute("DELETE FROM docs WHERE collection = ? AND id = ?", (collection, key))
+            else:
+                await self.conn.execute("INSERT OR REPLACE INTO docs VALUES (?, ?, ?)", (collection, key, doc))
+        await self.conn.commit()
+
+    async def find_one(self, collection, query, projection=None, sort=None):
+        await self._ready()
+        return await super().find_one(collection, query, projection, sort)
+
+    async def find(self, collection, query, projection=None, sort=None, limit=0, batch_size=None):
+        await self._ready()
+        async for doc in super().find(collection, query, projection, sort, limit, batch_size):
+            yield doc
+
+    async def count(self, collection, query):
+        await self._ready()
+        return await super().count(collection, query)
+
+    async def aggregate(self, collection, pipeline):
+        await self._ready()
+        async for doc in super().aggregate(collection, pipeline):
+            yield doc
+
+    async def insert_one(self, collection, doc):
+        await self._ready()
+        await super().insert_one(collection, doc)
+        await self._save()
+
+    async def update_one(self, collection, query, update, upsert=False):
+        await self._ready()
+        await super().update_one(collection, query, update, upsert)
+        await self._save()
+
+    async def find_one_and_update(self, collection, query, update, upsert=False, projection=None):
+        await self._ready()
+        doc = await super().find_one_and_update(collection, query, update, upsert, projection)
+        await self._save()
+        return doc
+
+    async def delete_one(self, collection, query):
+        await self._ready()
+        await super().delete_one(collection, query)
+        await self._save()
+
+    async def bulk_write(self, collection, ops):
+        await self._ready()
+        errors = await super().bulk_write(collection, ops)
+        await self._save()  # One commit for the whole batch
+        return errors
+
+    async def create_index(self, collection, keys, **options):
+        await self._ready()
+        await super().create_index(collection, keys, **options)
+
+    async def warm_up(self):
+        await self._ready()
+
+    async def close(self):
+        if self.conn:
+            await self._save()
+            await self.conn.close()
+            self.conn = None
+
+
+def make_backend() -> Backend:
+    kind = getenv("DB_BACKEND", "mongo").lower()
+
+    if kind == "mongo":
+        return MotorBackend(getenv("MONGO_URI"))
+    elif kind == "memory":
+        return MemoryBackend()
+    elif kind == "sqlite":
+        return SQLiteBackend(getenv("SQLITE_PATH", "qcbot.db"))
+    raise ValueError(f"Unknown DB_BACKEND {kind}, should be mongo, memory or sqlite")
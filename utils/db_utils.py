@@ -1,52 +1,615 @@
-from motor import motor_asyncio
 from os import getenv
+from collections import OrderedDict, Counter
+import asyncio
+from copy import deepcopy
+from time import monotonic, perf_counter
+import functools
+import inspect
+from utils.db_backends import make_backend
+from utils.utils import Timings
 
 # .env should be loaded by the bot. I totally expect this to break at some point
-MONGO_URI = getenv("MONGO_URI")
+# Mongo by default, see db_backends for the others
+backend = make_backend()
 
-_client = motor_asyncio.AsyncIOMotorClient(MONGO_URI)
-db = _client.qcbot
 
+# Latency tracking - every db call is timed under (collection, operation)
+timings = {}  # (collection, operation) -> Timings
+SLOW_QUERY_MS = float(getenv("DB_SLOW_MS", 250))
+
+
+def record_timing(collection: str, operation: str, seconds: float, error: bool = False):
+    key = (collection, operation)
+    if key not in timings:
+        timings[key] = Timings()
+    timings[key].record(seconds, error)
+
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        print(f"Slow db call: {operation} on {collection} took {seconds * 1000:.0f}ms")
+
+
+def timed(func):
+    """Decorator to time a db function, the collection is taken from its collection argument"""
+    signature = inspect.signature(func)
+
+    def collection_of(args, kwargs):
+        return signature.bind(*args, **kwargs).arguments.get("collection")
+
+    if inspect.isasyncgenfunction(func):
+        # Only count time spent waiting on the db, not whatever the caller does with each doc
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            gen = func(*args, **kwargs)
+            elapsed = 0
+            error = False
+            try:
+                while True:
+                    start = perf_counter()
+                    try:
+                        item = await gen.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    except Exception:
+                        error = True
+                        raise
+                    finally:
+                        elapsed += perf_counter() - start
+                    yield item
+            finally:
+                await gen.aclose()
+                record_timing(collection_of(args, kwargs), func.__name__, elapsed, error)
+    else:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = perf_counter()
+            error = False
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                error = True
+                raise
+            finally:
+                record_timing(collection_of(args, kwargs), func.__name__, perf_counter() - start, error)
+
+    return wrapper
+
+
+class DocCache:
+    """
+    An LRU cache of documents keyed by (collection, _id)
+    Only collections with a policy (see cache_policy) are cached, and each entry expires after its collection's TTL
+    Missing documents are cached too, so repeated lookups for new users don't keep hitting the db
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.policies = {}  # collection -> ttl in seconds
+        self._entries = OrderedDict()  # (collection, _id) -> (expires_at, doc)
+        self._reads = {}  # (collection, _id) -> [db reads in flight, written to since they started]
+        self._writes = Counter()  # (collection, _id) -> db writes in flight
+
+        self.hits = 0
+        self.misses = 0
+
+    def enabled(self, collection: str):
+        return self.max_size > 0 and collection in self.policies
+
+    def get(self, collection: str, _id):
+        """Returns (found, doc). doc may be None if the document is known not to exist"""
+        key = (collection, _id)
+        entry = self._entries.get(key)
+
+        if entry is None or entry[0] < monotonic():
+            if entry is not None:  # Expired
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, deepcopy(entry[1])
+
+    def put(self, collection: str, _id, doc):
+        key = (collection, _id)
+        self._entries[key] = (monotonic() + self.policies[collection], deepcopy(doc))
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)  # Evict the least recently used
+
+    def start_read(self, collection: str, _id):
+        """Call before reading a doc from the db to fill the cache with, see finish_read"""
+        key = (collection, _id)
+        entry = self._reads.setdefault(key, [0, False])
+        entry[0] += 1
+        if key in self._writes:
+            entry[1] = True
+
+    def finish_read(self, collection: str, _id, doc=None, store=True):
+        """
+        Cache a doc read from the db, unless the doc was written to at any point while the read was in flight
+        The read might have seen it from before the write, and caching that would serve it for the whole TTL
+        """
+        key = (collection, _id)
+        entry = self._reads[key]
+        entry[0] -= 1
+        if entry[0] == 0:
+            del self._reads[key]
+        if store and not entry[1]:
+            self.put(collection, _id, doc)
+
+    def start_write(self, collection: str, _id):
+        key = (collection, _id)
+        self._writes[key] += 1
+        self._written(key)
+
+    def finish_write(self, collection: str, _id):
+        key = (collection, _id)
+        self._writes[key] -= 1
+        if self._writes[key] <= 0:
+            del self._writes[key]
+        self._written(key)
+
+    def _written(self, key):
+        if key in self._reads:
+            self._reads[key][1] = True
+
+    def update(self, collection: str, _id, func):
+        """Apply func to a cached doc in place, write-through style. Does nothing if the doc isn't cached"""
+        key = (collection, _id)
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+
+        doc = entry[1] if entry[1] is not None else {}
+        func(doc)
+        self._entries[key] = (entry[0], doc)
+
+    def invalidate(self, collection: str, _id=None):
+        """Drop a single doc, or the whole collection if no _id is given"""
+        if _id is not None:
+            self._written((collection, _id))
+            self._entries.pop((collection, _id), None)
+        else:
+            for key in [key for key in self._reads if key[0] == collection]:
+                self._written(key)
+            for key in [key for key in self._entries if key[0] == collection]:
+                del self._entries[key]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0,
+        }
+
+
+cache = DocCache(int(getenv("DB_CACHE_SIZE", 4096)))
+
+
+def cache_policy(collection: str, ttl: float):
+    """Opt a collection into the document cache. Cached docs are served for up to ttl seconds"""
+    cache.policies[collection] = ttl
+
+
+class BulkWriter:
+    """
+    Collects writes per collection and sends each collection's batch as unordered bulk_writes
+    A batch is flushed once it reaches max_ops, or interval seconds after its first write, whichever comes first
+    Writes to the same doc are split across successive bulk_writes, so they still land in the order they were queued
+    """
+
+    def __init__(self, max_ops: int, interval: float):
+        self.max_ops = max_ops
+        self.interval = interval
+        self._pending = {}  # collection -> [(op, future or None, cached _id or None)]
+        self._timers = {}  # collection -> asyncio.TimerHandle
+        self._flushing = set()  # In flight flush tasks, kept so they don't get garbage collected
+
+    def queue(self, collection: str, op, wait: bool, _id=None):
+        """
+        Add a write to the buffer
+        If wait is true a future is returned which resolves once the write has been flushed
+        _id is the doc the write is to, if it might be cached. get_doc won't cache it until the write is flushed
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future() if wait else None
+
+        if _id is not None:
+            cache.start_write(collection, _id)
+        batch = self._pending.setdefault(collection, [])
+        batch.append((op, future, _id))
+
+        if len(batch) >= self.max_ops:
+            self._schedule_flush(collection)
+        elif collection not in self._timers:
+            self._timers[collection] = loop.call_later(self.interval, self._schedule_flush, collection)
+
+        return future
+
+    def _schedule_flush(self, collection: str):
+        task = asyncio.create_task(self.flush(collection))
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def flush(self, collection: str = None):
+        """Write out everything buffered for a collection, or for every collection if none is given"""
+        collections = [collection] if collection else list(self._pending)
+
+        for collection in collections:
+            timer = self._timers.pop(collection, None)
+            if timer:
+                timer.cancel()
+
+            batch = self._pending.pop(collection, None)
+            if not batch:
+                continue
+
+            errors = {}
+            for indexes in _rounds([op for op, _, _ in batch]):
+                start = perf_counter()
+                try:
+                    round_errors = await backend.bulk_write(collection, [batch[i][0] for i in indexes])
+                except Exception as e:
+                    round_errors = {n: e for n in range(len(indexes))}
+                record_timing(collection, "bulk_write", perf_counter() - start, bool(round_errors))
+                errors.update((indexes[n], error) for n, error in round_errors.items())
+
+            for i, (op, future, _id) in enumerate(batch):
+                error = errors.get(i)
+                if _id is not None:
+                    if error:
+                        cache.invalidate(collection, _id)  # It may have been updated on the assumption this worked
+                    cache.finish_write(collection, _id)
+                if future is None:
+                    if error:
+                        print(f"Buffered write to {collection} failed: {op} - {error}")
+                elif not future.done():
+                    if error:
+                        future.set_exception(error)
+                    else:
+                        future.set_result(None)
+
+    async def close(self):
+        """Flush everything, including batches that are already mid-flush"""
+        await self.flush()
+        if self._flushing:
+            await asyncio.gather(*self._flushing, return_exceptions=True)
+
+
+def _target(op: tuple):
+    """What doc a write tuple is for, or None if it can't be told from the op"""
+    kind, *args = op
+    if kind == "insert":
+        return ("_id", repr(args[0]["_id"])) if "_id" in args[0] else None
+
+    query = args[0]
+    _id = query.get("_id")
+    if _id is not None:
+        if isinstance(_id, dict):
+            if list(_id) != ["$eq"]:
+                return ("query", repr(query))
+            _id = _id["$eq"]
+        return ("_id", repr(_id))
+    return ("query", repr(query))
+
+
+def _rounds(ops: list) -> list:
+    """
+    Split a batch into rounds of indexes, with no doc written to twice in the same round
+    An unordered bulk_write can apply its ops in any order, so the nth write to a doc goes in the nth round
+    Nearly every batch is a single round
+    """
+    rounds = []
+    seen = Counter()
+    for i, op in enumerate(ops):
+        target = _target(op)
+        n = seen[target] if target is not None else 0
+        if target is not None:
+            seen[target] += 1
+        if n == len(rounds):
+            rounds.append([])
+        rounds[n].append(i)
+    return rounds
+
+
+writer = BulkWriter(max_ops=int(getenv("DB_BULK_MAX_OPS", 500)), interval=float(getenv("DB_BULK_INTERVAL", 1)))
+
+
+# Index registry. Cogs declare the indexes their queries need and ensure_indexes creates them at startup
+_indexes = {}  # collection -> {name: (keys, options)}
+_query_shapes = Counter()  # (collection, query fields, sort fields) -> times seen
 
-async def get_doc(_id: str, collection: str, default=None):
-    """Gets db.collection.doc[_id]"""
-    collection = db[collection]
 
-    doc = await collection.find_one({"_id": {"$eq": _id}}, {"_id": 0})
+def declare_index(collection: str, keys: list, **options):
+    """
+    Declare an index, keys are in the same form as pymongo's create_index e.g. [("user", 1), ("timestamp", -1)]
+    Extra options (unique etc.) are passed straight on to create_index
+    """
+    name = options.setdefault("name", "_".join(f"{field}_{direction}" for field, direction in keys))
+    _indexes.setdefault(collection, {})[name] = (keys, options)
+
+
+async def ensure_indexes():
+    """Create every declared index. create_index is a no-op for indexes that already exist, so this is safe to rerun"""
+    for collection, indexes in _indexes.items():
+        for name, (keys, options) in indexes.items():
+            start = perf_counter()
+            try:
+                await backend.create_index(collection, keys, **options)
+            except Exception as e:
+                # Don't take the bot down over an index, but make some noise about it
+                print(f"Failed to create index {collection}.{name}: {e}")
+                record_timing(collection, "create_index", perf_counter() - start, True)
+            else:
+                record_timing(collection, "create_index", perf_counter() - start)
+
+
+def _fields(spec) -> tuple:
+    """Top level field names of a query or sort spec, ignoring operators like $or. $text is kept, it needs an index"""
+    if not spec:
+        return ()
+    if isinstance(spec, dict):
+        spec = spec.keys()
+    else:  # Sort list of (field, direction)
+        spec = [field for field, _ in spec]
+    return tuple(sorted(field for field in spec if not field.startswith("$") or field == "$text"))
+
+
+def _record_query(collection: str, query, sort=None):
+    _query_shapes[(collection, _fields(query), _fields(sort))] += 1
+
+
+def is_covered(collection: str, fields: tuple, sort_fields: tuple = ()) -> bool:
+    """
+    Rough check of whether a declared index can serve a query
+    An index is usable if the query filters on its first field, or sorts on it when there's no filter
+    """
+    leading = {"_id"}  # Always indexed
+    for keys, _ in _indexes.get(collection, {}).values():
+        leading.add(keys[0][0])
+        if any(kind == "text" for _, kind in keys):
+            leading.add("$text")
+
+    if fields:
+        return any(field in leading for field in fields)
+    return not sort_fields or sort_fields[0] in leading
+
+
+def index_report():
+    """Returns (declared indexes, uncovered query shapes with how often they've been run)"""
+    declared = {collection: list(indexes) for collection, indexes in _indexes.items()}
+    uncovered = [(shape, count) for shape, count in _query_shapes.most_common() if not is_covered(*shape)]
+    return declared, uncovered
+
+
+async def _write(collection: str, op: tuple, buffered: bool, wait: bool, _id=None):
+    """
+    Perform a write now, or hand it to the bulk writer. op is a write tuple, see db_backends
+    buffered=True, wait=True waits until the batch containing the write has been flushed
+    buffered=True, wait=False is fire and forget, failures only get printed
+    _id is the doc being written to if it might be cached, see BulkWriter.queue
+    """
+    if buffered:
+        future = writer.queue(collection, op, wait, _id)
+        if future:
+            await future
+        return
+
+    kind, *args = op
+    if kind == "insert":
+        await backend.insert_one(collection, *args)
+    elif kind == "update":
+        await backend.update_one(collection, *args)
+    elif kind == "delete":
+        await backend.delete_one(collection, *args)
+
+
+async def warm_up() -> float:
+    """Connect to the db ahead of time. Returns how long it took in seconds"""
+    start = perf_counter()
+    try:
+        await backend.warm_up()
+    except Exception:
+        record_timing("admin", "warm_up", perf_counter() - start, True)
+        raise
+
+    took = perf_counter() - start
+    record_timing("admin", "warm_up", took)
+    return took
+
+
+# Untimed versions of public functions, for the ones built on them so each call is only timed once
+async def _get_doc(_id: str, collection: str, default=None):
+    if cache.enabled(collection):
+        found, doc = cache.get(collection, _id)
+        if not found:
+            cache.start_read(collection, _id)
+            try:
+                doc = await backend.find_one(collection, {"_id": {"$eq": _id}}, {"_id": 0})
+            except Exception:
+                cache.finish_read(collection, _id, store=False)
+                raise
+            cache.finish_read(collection, _id, doc)
+    else:
+        doc = await backend.find_one(collection, {"_id": {"$eq": _id}}, {"_id": 0})
+
     return doc if doc else default
 
 
+async def _iter_docs(collection, query, projection=None, sort=None, limit=0, batch_size=None):
+    _record_query(collection, query, sort)
+    async for doc in backend.find(collection, query, projection, sort, limit, batch_size):
+        yield doc
+
+
+@timed
+async def get_doc(_id: str, collection: str, default=None):
+    """Gets db.collection.doc[_id]"""
+    return await _get_doc(_id, collection, default)
+
+
+@timed
 async def get_prop(_id: str, collection: str, prop, default=None):
     """db.collection.doc[_id].prop"""
-    doc: dict = await get_doc(_id, collection, default={})
+    doc: dict = await _get_doc(_id, collection, default={})
     return doc.get(str(prop), default)
 
 
-async def del_prop(_id: str, collection: str, prop):
-    collection = db[collection]
-    await collection.update_one({"_id": {"$eq": _id}}, {"$unset": {str(prop): ""}})
+async def _cached_write(collection: str, _id, op: tuple, buffered: bool, wait: bool, apply=None):
+    """Write a single doc, keeping the cache in step. apply updates the cached doc, otherwise it's just dropped"""
+    if apply:
+        cache.update(collection, _id, apply)
+    else:
+        cache.invalidate(collection, _id)
+
+    cache.start_write(collection, _id)  # So a get_doc racing this write doesn't cache what it read
+    try:
+        await _write(collection, op, buffered, wait, _id)
+    except Exception:
+        cache.invalidate(collection, _id)
+        raise
+    finally:
+        cache.finish_write(collection, _id)
+
 
+@timed
+async def del_prop(_id: str, collection: str, prop, buffered=False, wait=True):
+    prop = str(prop)
+    op = ("update", {"_id": {"$eq": _id}}, {"$unset": {prop: ""}})
+    # Nested fields aren't worth replicating in the cache, just drop the doc
+    apply = (lambda doc: doc.pop(prop, None)) if "." not in prop else None
 
-async def set_prop(_id: str, collection: str, prop, value):
-    collection = db[collection]
-    await collection.update_one({"_id": {"$eq": _id}}, {"$set": {str(prop): value}}, upsert=True)
+    await _cached_write(collection, _id, op, buffered, wait, apply)
 
 
-async def insert_doc(collection, document):
-    collection = db[collection]
-    await collection.insert_one(document)
+@timed
+async def set_prop(_id: str, collection: str, prop, value, buffered=False, wait=True):
+    prop = str(prop)
+    op = ("update", {"_id": {"$eq": _id}}, {"$set": {prop: value}}, True)
+    apply = (lambda doc: doc.__setitem__(prop, deepcopy(value))) if "." not in prop else None
 
+    await _cached_write(collection, _id, op, buffered, wait, apply)
 
-async def find_docs(collection, query, limit=0):
-    collection = db[collection]
-    results = collection.find(query, limit=limit)
-    return await flatten(results)
 
+@timed
+async def update_doc(_id, collection: str, update: dict, upsert=False, buffered=False, wait=True, where: dict = None):
+    """
+    Apply a raw mongo update ($inc, $max etc.) to db.collection.doc[_id]
+    where adds conditions the doc has to meet for the update to happen, e.g. {"count": {"$gt": 0}}
+    """
+    query = {"_id": {"$eq": _id}, **(where or {})}
+    await _cached_write(collection, _id, ("update", query, update, upsert), buffered, wait)
 
-async def del_doc(_id: str, collection: str, key="_id"):
+
+@timed
+async def increment(_id, collection: str, prop, amount=1) -> int:
+    """Atomically add amount to db.collection.doc[_id].prop (creating it if needed) and return the new value"""
+    cache.invalidate(collection, _id)
+    cache.start_write(collection, _id)
+    try:
+        doc = await backend.find_one_and_update(collection, {"_id": {"$eq": _id}}, {"$inc": {str(prop): amount}},
+                                                upsert=True, projection={str(prop): 1})
+    finally:
+        cache.finish_write(collection, _id)
+    return doc[str(prop)]
+
+
+@timed
+async def insert_doc(collection, document, buffered=False, wait=True):
+    if "_id" in document:
+        await _cached_write(collection, document["_id"], ("insert", document), buffered, wait)
+    else:
+        await _write(collection, ("insert", document), buffered, wait)
+
+
+@timed
+async def insert_docs(collection, documents: list) -> dict:
+    """Insert many docs in one unordered round trip. Returns {index: exception} for any that failed"""
+    if not documents:
+        return {}
+    return await backend.bulk_write(collection, [("insert", document) for document in documents])
+
+
+@timed
+async def find_doc(collection, query, projection=None, sort=None):
+    """Get the first doc matching the query, or None"""
+    _record_query(collection, query, sort)
+    return await backend.find_one(collection, query, projection, sort)
+
+
+@timed
+async def iter_docs(collection, query, projection=None, sort=None, limit=0, batch_size=None):
+    """
+    Stream docs matching the query without loading them all into memory
+    projection and sort take the same form as pymongo's find, e.g. {"reason": 1} and [("timestamp", -1)]
+    """
+    async for doc in _iter_docs(collection, query, projection, sort, limit, batch_size):
+        yield doc
+
+
+@timed
+async def find_docs(collection, query, limit=0, projection=None, sort=None):
+    return [doc async for doc in _iter_docs(collection, query, projection, sort, limit)]
+
+
+_aggregate_cache = {}  # (collection, repr of pipeline) -> (expires_at, results)
+
+
+@timed
+async def aggregate(collection, pipeline: list, ttl: float = 0):
+    """
+    Run an aggregation pipeline and return the results as a list, so keep them small ($group, $limit etc.)
+    If ttl is given, the same pipeline is answered from memory for that many seconds
+    """
+    if pipeline and "$match" in pipeline[0]:
+        _record_query(collection, pipeline[0]["$match"])
+
+    key = (collection, repr(pipeline))
+    now = monotonic()
+
+    if ttl:
+        cached = _aggregate_cache.get(key)
+        if cached and cached[0] > now:
+            return deepcopy(cached[1])
+
+    results = [doc async for doc in backend.aggregate(collection, pipeline)]
+
+    if ttl:
+        # Drop anything expired while we're here so this doesn't grow forever
+        for old in [old for old, (expires_at, _) in _aggregate_cache.items() if expires_at <= now]:
+            del _aggregate_cache[old]
+        _aggregate_cache[key] = (now + ttl, deepcopy(results))
+
+    return results
+
+
+@timed
+async def count_docs(collection, query):
+    _record_query(collection, query)
+    return await backend.count(collection, query)
+
+
+@timed
+async def del_doc(_id: str, collection: str, key="_id", buffered=False, wait=True):
     """Completely removes a doc"""
-    collection = db[collection]
-    await collection.delete_one({key: {"$eq": _id}})
+    op = ("delete", {key: {"$eq": _id}})
+    _record_query(collection, op[1])
+
+    if key == "_id":
+        await _cached_write(collection, _id, op, buffered, wait)
+    else:  # No idea which cached doc that was
+        cache.invalidate(collection)
+        await _write(collection, op, buffered, wait)
+
+
+async def close_db():
+    """Flush anything still buffered and disconnect. Should be called before the bot shuts down"""
+    await writer.close()
+    await backend.close()
 
 
 async def flatten(cursor):
@@ -0,0 +1,66 @@
+import asyncio
+import time
+import traceback
+
+import discord
+
+from utils.utils import latencies
+
+# name -> handler, called with a MemberUpdate for every on_member_update
+_member_update_handlers = {}
+
+
+class MemberUpdate:
+    """What changed in an on_member_update, worked out once and shared by every handler"""
+    __slots__ = ("old", "new", "added", "removed", "nick_changed")
+
+    def __init__(self, old: discord.Member, new: discord.Member):
+        self.old = old
+        self.new = new
+
+        old_roles = {role.id for role in old.roles}
+        new_roles = {role.id for role in new.roles}
+        self.added = new_roles - old_roles  # Role IDs
+        self.removed = old_roles - new_roles
+        self.nick_changed = old.display_name != new.display_name
+
+    @property
+    def roles_changed(self) -> bool:
+        return bool(self.added or self.removed)
+
+
+def subscribe_member_update(name: str, handler):
+    """
+    Have handler (a coroutine function taking a MemberUpdate) called on every member update
+    Subscribing again under the same name replaces the old handler, so cogs can be reloaded
+    """
+    _member_update_handlers[name] = handler
+
+
+def unsubscribe_member_update(name: str):
+    _member_update_handlers.pop(name, None)
+
+
+async def _run_handler(name: str, handler, update: MemberUpdate):
+    start = time.perf_counter()
+    error = False
+    try:
+        await handler(update)
+    except Exception:
+        error = True
+        print(f"Member update handler {name} failed")
+        traceback.print_exc()
+    finally:
+        latencies[f"on_member_update: {name}"].record(time.perf_counter() - start, error)
+
+
+async def dispatch_member_update(old: discord.Member, new: discord.Member):
+    """
+    The bot's only on_member_update listener. Handlers run concurrently, one failing doesn't affect the others
+    Per handler timings are recorded in latencies, see /latency
+    """
+    if not _member_update_handlers:
+        return
+
+    update = MemberUpdate(old, new)
+    await asyncio.gather(*(_run_handler(name, handler, update) for name, handler in _member_update_handlers.items()))
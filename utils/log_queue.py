@@ -0,0 +1,113 @@
+import asyncio
+import time
+from collections import deque
+
+import discord
+
+from utils.utils import Timings
+
+EMBEDS_PER_MESSAGE = 10  # Discord's limit
+CHARS_PER_MESSAGE = 6000  # Discord's limit on the total size of every embed in a message
+FLUSH_INTERVAL = 2  # Seconds to wait for more embeds before sending a part filled message
+
+
+class LogQueue:
+    """
+    Batches everything going to a log channel so bursts don't run into the per channel rate limit
+    Up to 10 embeds are packed into each message, anything with a file or text content goes on its own
+    A single task does all the sending so order is always preserved
+    """
+
+    def __init__(self, bot, channel_id: int, interval: float = FLUSH_INTERVAL):
+        self.bot = bot
+        self.channel_id = channel_id
+        self.interval = interval
+
+        self.queue = deque()  # (queued at, embed, file, content)
+        self.pending = asyncio.Event()  # Something is waiting to be sent
+        self.full = asyncio.Event()  # Enough is waiting to fill a message, so don't wait for the interval
+        self.task = None
+        self.closing = False
+
+        self.lag = Timings()  # Time from being queued to being sent
+        self.sent = 0  # Items
+        self.messages = 0  # Messages those items were packed into
+        self.dropped = 0
+
+    def put(self, embed: discord.Embed = None, file: discord.File = None, content: str = None):
+        self.queue.append((time.perf_counter(), embed, file, content))
+        self.pending.set()
+        if len(self.queue) >= EMBEDS_PER_MESSAGE:
+            self.full.set()
+
+        if (self.task is None or self.task.done()) and not self.closing:  # Once closing, close() sends the rest
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    @property
+    def depth(self) -> int:
+        return len(self.queue)
+
+    @property
+    def oldest(self) -> float:
+        """How long the oldest queued item has been waiting, in seconds"""
+        return time.perf_counter() - self.queue[0][0] if self.queue else 0
+
+    async def run(self):
+        while not self.closing:
+            await self.pending.wait()
+            if len(self.queue) < EMBEDS_PER_MESSAGE and not self.closing:
+                try:
+                    await asyncio.wait_for(self.full.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            self.pending.clear()
+            self.full.clear()
+
+            await self.flush()
+
+    def next_batch(self) -> list:
+        """Pop the next message's worth of items off the front of the queue, within both of discord's limits"""
+        batch = [self.queue.popleft()]
+        _, embed, file, content = batch[0]
+        if file or content:
+            return batch
+
+        chars = len(embed)
+        while self.queue and len(batch) < EMBEDS_PER_MESSAGE:
+            _, embed, file, content = self.queue[0]
+            if file or content or chars + len(embed) > CHARS_PER_MESSAGE:
+                break
+            chars += len(embed)
+            batch.append(self.queue.popleft())
+        return batch
+
+    async def flush(self):
+        while self.queue:
+            batch = self.next_batch()
+            channel = self.bot.get_channel(self.channel_id)
+
+            try:
+                if len(batch) == 1:
+                    _, embed, file, content = batch[0]
+                    await channel.send(content, embed=embed, file=file)
+                else:
+                    await channel.send(embeds=[embed for _, embed, _, _ in batch])
+            except (discord.HTTPException, AttributeError) as e:  # AttributeError if the channel isn't cached
+                print(f"Failed to send {len(batch)} log item(s): {e}")
+                self.dropped += len(batch)
+                continue
+
+            now = time.perf_counter()
+            for queued, *_ in batch:
+                self.lag.record(now - queued)
+            self.sent += len(batch)
+            self.messages += 1
+
+    async def close(self):
+        """Send whatever is left, used on shutdown. The sender finishes what it's doing rather than being cancelled"""
+        self.closing = True
+        self.pending.set()
+        self.full.set()
+        if self.task and not self.task.done():
+            await self.task
+        await self.flush()
@@ -0,0 +1,95 @@
+import sys
+import time
+from collections import OrderedDict
+from os import getenv
+
+import discord
+
+MESSAGE_STORE_MB = int(getenv("MESSAGE_STORE_MB", 64))  # Roughly how much memory message history can use
+ENTRY_OVERHEAD = 100  # Bytes per entry for the OrderedDict's key, hash slot and links, near enough
+
+
+class StoredMessage:
+    """Just enough of a message to log it after it's deleted or edited"""
+    __slots__ = ("id", "author_id", "author_name", "channel_id", "content", "attachments")
+
+    def __init__(self, message_id: int, author_id: int, author_name: str, channel_id: int, content: str,
+                 attachments: tuple):
+        self.id = message_id
+        self.author_id = author_id
+        self.author_name = author_name
+        self.channel_id = channel_id
+        self.content = content
+        self.attachments = attachments  # URLs
+
+    @classmethod
+    def from_message(cls, message: discord.Message):
+        return cls(message.id, message.author.id, str(message.author), message.channel.id, message.content,
+                   tuple(attachment.url for attachment in message.attachments))
+
+    @property
+    def created_at(self):
+        return discord.utils.snowflake_time(self.id)
+
+    def size(self) -> int:
+        """Approximate bytes used, including the strings it holds"""
+        return sys.getsizeof(self) + sys.getsizeof(self.content) + sys.getsizeof(self.author_name) + \
+            sys.getsizeof(self.attachments) + sum(sys.getsizeof(url) for url in self.attachments) + ENTRY_OVERHEAD
+
+
+def format_stored(message: StoredMessage) -> str:
+    """Transcript formatter for stored messages, see utils.transcript"""
+    lines = [f"{message.created_at.isoformat()} | {message.author_name} ({message.author_id})"]
+    lines += [f"[file] {url}" for url in message.attachments]
+    if message.content:
+        lines.append(message.content)
+    return "\n".join(lines) + "\n\n"
+
+
+class MessageStore:
+    """
+    Message id -> StoredMessage, oldest evicted first once it goes over max_bytes
+    Independent of discord's message cache, which only keeps the last 1000 messages as full objects
+    """
+
+    def __init__(self, max_bytes: int = MESSAGE_STORE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.messages = OrderedDict()
+        self.bytes = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, message: StoredMessage):
+        self.pop(message.id)
+        self.messages[message.id] = message
+        self.bytes += message.size()
+
+        while self.bytes > self.max_bytes and self.messages:
+            _, old = self.messages.popitem(last=False)
+            self.bytes -= old.size()
+            self.evicted += 1
+
+    def get(self, message_id: int):
+        return self.messages.get(message_id)
+
+    def pop(self, message_id: int):
+        message = self.messages.pop(message_id, None)
+        if message:
+            self.bytes -= message.size()
+        return message
+
+    def edit(self, message_id: int, content: str):
+        message = self.messages.get(message_id)
+        if message:
+            self.bytes += sys.getsizeof(content) - sys.getsizeof(message.content)
+            message.content = content
+
+    def stats(self) -> str:
+        oldest = ""
+        if self.messages:
+            age = time.time() - next(iter(self.messages.values())).created_at.timestamp()
+            oldest = f" | oldest {age / 86400:.1f} days"
+        return f"{len(self.messages)} messages | {self.bytes / 1024 / 1024:.1f}/{self.max_bytes / 1024 / 1024:.0f}MB" \
+               f"{oldest} | {self.evicted} evicted"
@@ -0,0 +1,151 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+import aiohttp
+
+PK_MESSAGE_ENDPOINT = "https://api.pluralkit.me/v2/messages"
+PK_RATE = 2  # Requests per second, PK's published limit for the API
+PK_BURST = 2
+PK_CACHE_SIZE = 10000  # Message IDs to remember the answer for
+PK_RETRIES = 2  # Times to retry after a 429 before giving up
+PK_MAX_RETRY_AFTER = 10  # Seconds, don't hold a lookup up for longer than this
+PK_TIMEOUT = 10  # Seconds per request
+PK_MAX_IN_FLIGHT = 4  # Concurrent requests during check_many
+USER_AGENT = "Queer Coded discord bot (message logs)"
+
+
+class TokenBucket:
+    """
+    Allows rate requests per second on average, with bursts of up to capacity
+    acquire() waits until a request is allowed
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0  # Set when the server tells us to back off
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:  # Waiters are served in order
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block(self, seconds: float):
+        """Stop handing out tokens for a while, e.g. because of a Retry-After"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+def retry_after(headers) -> float:
+    """Seconds to back off for from a 429, PK sends X-RateLimit-Reset (epoch ms) rather than always Retry-After"""
+    if "Retry-After" in headers:
+        return float(headers["Retry-After"])
+    if "X-RateLimit-Reset" in headers:
+        return max(0.0, int(headers["X-RateLimit-Reset"]) / 1000 - time.time())
+    return 1
+
+
+class PKClient:
+    """
+    Checks whether messages were proxied by PluralKit
+    One session is kept open and reused, requests go through a token bucket so PK doesn't rate limit us and answers are
+    kept in an LRU cache since they never change
+    """
+
+    def __init__(self, cache_size: int = PK_CACHE_SIZE):
+        self.session = None  # Made on first use, it has to be created inside the event loop
+        self.bucket = TokenBucket(PK_RATE, PK_BURST)
+        self.cache = OrderedDict()  # message id -> bool
+        self.cache_size = cache_size
+
+        self.hits = 0
+        self.requests = 0
+        self.rate_limited = 0
+        self.failed = 0
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(headers={"User-Agent": USER_AGENT},
+                                                 timeout=aiohttp.ClientTimeout(total=PK_TIMEOUT))
+        return self.session
+
+    def remember(self, message_id: int, result: bool):
+        self.cache[message_id] = result
+        self.cache.move_to_end(message_id)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def is_pk_msg(self, message_id: int):
+        """
+        Returns True or False, or None if PK couldn't tell us (rate limited or down)
+        """
+        if message_id in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(message_id)
+            return self.cache[message_id]
+
+        for _ in range(PK_RETRIES + 1):
+            await self.bucket.acquire()
+            self.requests += 1
+            try:
+                async with self.get_session().get(f"{PK_MESSAGE_ENDPOINT}/{message_id}") as response:
+                    # 200 means it is a pk message, 404 means it isn't
+                    if response.status in (200, 404):
+                        result = response.status == 200
+                        self.remember(message_id, result)
+                        return result
+
+                    if response.status == 429:
+                        self.rate_limited += 1
+                        self.bucket.block(min(retry_after(response.headers), PK_MAX_RETRY_AFTER))
+                        continue
+
+                    print(f"PK returned {response.status} for message {message_id}")
+                    break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"PK lookup for message {message_id} failed: {e!r}")
+                break
+
+        self.failed += 1
+        return None
+
+    async def check_many(self, message_ids) -> dict:
+        """
+        Look up lots of messages together. Duplicates are only looked up once and at most PK_MAX_IN_FLIGHT requests
+        are made at a time. Returns message id -> is_pk_msg result
+        """
+        message_ids = list(dict.fromkeys(message_ids))
+        semaphore = asyncio.Semaphore(PK_MAX_IN_FLIGHT)
+
+        async def check(message_id):
+            async with semaphore:
+                return await self.is_pk_msg(message_id)
+
+        results = await asyncio.gather(*(check(message_id) for message_id in message_ids))
+        return dict(zip(message_ids, results))
+
+    def stats(self) -> str:
+        return f"{self.requests} requests | {self.hits} cache hits ({len(self.cache)} cached) | " \
+               f"{self.rate_limited} rate limited | {self.failed} unknown"
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
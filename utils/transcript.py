@@ -0,0 +1,96 @@
+import asyncio
+import gzip
+import json
+import shutil
+from tempfile import TemporaryFile
+
+import discord
+
+GZIP_THRESHOLD = 1024 * 1024  # Compress transcripts bigger than 1MB
+EMBED_SUMMARY_LENGTH = 200
+
+
+def embed_summary(embed: discord.Embed) -> str:
+    parts = [str(part) for part in (embed.title, embed.description) if part]
+    return " - ".join(parts)[:EMBED_SUMMARY_LENGTH]
+
+
+def format_text(message) -> str:
+    lines = [f"{message.created_at.isoformat()} | {message.author} ({message.author.id})"]
+
+    for embed in message.embeds:
+        if embed.type == "rich":
+            lines.append(f"[embed] {embed_summary(embed)}")
+    for attachment in message.attachments:
+        lines.append(f"[file] {attachment.url}")
+    if message.content:
+        lines.append(message.content)
+
+    return "\n".join(lines) + "\n\n"
+
+
+def format_jsonl(message) -> str:
+    return json.dumps({
+        "id": str(message.id),
+        "timestamp": message.created_at.isoformat(),
+        "author": str(message.author),
+        "author_id": str(message.author.id),
+        "content": message.content,
+        "attachments": [attachment.url for attachment in message.attachments],
+        "embeds": [embed_summary(embed) for embed in message.embeds if embed.type == "rich"],
+    }) + "\n"
+
+
+FORMATS = {
+    "txt": format_text,
+    "jsonl": format_jsonl,
+}
+
+
+class TranscriptWriter:
+    """
+    Builds a transcript a chunk at a time, for when the messages aren't all available up front
+    Formatting and writing happen in a thread so big transcripts don't block the bot, and go to a temp file rather
+    than memory. Not a SpooledTemporaryFile, before 3.11 that isn't an IOBase so discord.File can't take it
+    Works for anything given a formatter, not just messages. compress forces gzip on or off, by default only big
+    transcripts are compressed
+    """
+
+    def __init__(self, fmt: str = "txt", formatter=None, header: str = "", compress: bool = None):
+        self.fmt = fmt
+        self.formatter = formatter or FORMATS[fmt]
+        self.compress = compress
+        self.file = TemporaryFile()
+        self.file.write(header.encode())
+        self.count = 0
+
+    def write(self, messages):
+        for message in messages:
+            self.file.write(self.formatter(message).encode())
+            self.count += 1
+
+    async def add(self, messages):
+        await asyncio.to_thread(self.write, messages)
+
+    def finish(self):
+        """Returns the file (rewound) and whether it was gzipped"""
+        compress = self.compress if self.compress is not None else self.file.tell() > GZIP_THRESHOLD
+        if not compress:
+            self.file.seek(0)
+            return self.file, False
+
+        # Compress it into a second file. Both are streamed so nothing is held in memory all at once
+        self.file.seek(0)
+        compressed = TemporaryFile()
+        with gzip.GzipFile(fileobj=compressed, mode="wb") as gz:
+            shutil.copyfileobj(self.file, gz)
+        self.file.close()
+
+        compressed.seek(0)
+        return compressed, True
+
+    async def to_file(self, name: str) -> discord.File:
+        file, gzipped = await asyncio.to_thread(self.finish)
+
+        filename = f"{name}.{self.fmt}" + (".gz" if gzipped else "")
+        return discord.File(file, filename=filename)
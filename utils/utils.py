@@ -1,9 +1,11 @@
 from math import ceil
+from collections import deque, defaultdict
 
 import discord
 from discord.ext import commands
 import re
 import datetime as dt
+import traceback as tb
 
 LETTERS = ["🇦", "🇧", "🇨", "🇩", "🇪", "🇫", "🇬", "🇭", "🇮", "🇯", "🇰", "🇱", "🇲", "🇳", "🇴", "🇵", "🇶", "🇷",
            "🇸", "🇹", "🇺", "🇻", "🇼", "🇽", "🇾", "🇿"]
@@ -19,6 +21,57 @@ def chunks(lst: list, n: int):
         yield lst[i:i + n]
 
 
+class Timings:
+    """
+    Latency histogram for something we want to keep an eye on
+    Percentiles are worked out from the most recent samples, counts cover everything since startup
+    """
+
+    def __init__(self, samples: int = 1000):
+        self.samples = deque(maxlen=samples)  # Seconds
+        self.count = 0
+        self.errors = 0
+        self.max = 0
+
+    def record(self, seconds: float, error: bool = False):
+        self.samples.append(seconds)
+        self.count += 1
+        self.max = max(self.max, seconds)
+        if error:
+            self.errors += 1
+
+    def percentile(self, p: float) -> float:
+        """p is between 0 and 100. Returns seconds"""
+        if not self.samples:
+            return 0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def summary(self) -> str:
+        """One line summary in milliseconds"""
+        p50, p95, p99 = (self.percentile(p) * 1000 for p in (50, 95, 99))
+        return f"{self.count} calls | p50 {p50:.1f}ms p95 {p95:.1f}ms p99 {p99:.1f}ms | {self.errors} errors"
+
+
+# Bot side latencies worth watching, e.g. how long a mod waits for a command's response. Shown by /latency
+latencies = defaultdict(Timings)
+
+
+def traceback(e: Exception):  # Converts an exception into the full traceback report
+    return ''.join(tb.format_exception(None, e, e.__traceback__))
+
+
+def _crop(text: str, chars=2000, border="--Snippet--"):
+    """
+    Crop text to a certain character length based on word borders
+    """
+    if len(text) > chars:
+        text = text[:chars - len(border)]  # initial crop, just get the character count right
+        text = " ".join(text.split(" ")[:-1])  # cut off at nearest word boundary
+        text += border  # append border to signify cut off
+    return text
+
+
 class Page(discord.ui.View):
     """
     A UI view that lets you scroll through pages
@@ -90,6 +143,27 @@ class Page(discord.ui.View):
             pass
 
 
+class LazyPage(Page):
+    """
+    A Page where each page is only built the first time it's viewed
+    get_page is a coroutine that takes a page index and returns the embed for it
+    """
+
+    def __init__(self, ctx: commands.Context, get_page, max_page: int, index: int = 0, footer: str = None):
+        super().__init__(ctx, [None] * max_page, index, footer)
+        self.get_page = get_page
+
+    async def page(self, index: int) -> discord.Embed:
+        if self.pages[index] is None:
+            self.pages[index] = await self.get_page(index)
+        return self.pages[index]
+
+    async def update(self, interaction: discord.Interaction):
+        embed = await self.page(self.index)
+        embed = self.set_embed_footer(embed)
+        await interaction.response.edit_message(embed=embed)
+
+
 def pos_int(digit: str):
     """Ensures the input is a positive integer"""
     if digit.isdigit() and int(digit) > 0: